@@ -0,0 +1,119 @@
+"""Regression run: large directory trees over local://.
+
+Each tree's manifest and diff are far bigger than a pipe's buffer, which
+once deadlocked the client and the agent when they were pipelined. The
+scenario is converged and then run again once converged, and the run fails
+if either doesn't complete within --timeout seconds.
+
+    python -m benchmarks.directories [--trees 2] [--files 4000] [--timeout 60]
+"""
+
+import argparse
+import contextlib
+import grp
+import io
+import os
+import os.path
+import pwd
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from stagehand import runner
+
+from .fleet import _FAKE_MODULES
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sync large directory trees over local:// and time it"
+    )
+    parser.add_argument("--trees", type=int, help="Directory trees", default=2)
+    parser.add_argument("--files", type=int, help="Files per tree", default=4000)
+    parser.add_argument(
+        "--timeout", type=float, help="Seconds each run may take", default=60.0
+    )
+    args = parser.parse_args()
+
+    # the agent runs as a local subprocess, with the fake apt and dbus
+    os.environ["PYTHONPATH"] = _FAKE_MODULES
+    with tempfile.TemporaryDirectory(prefix="stagehand-dirs-") as work:
+        scenario_file = write_scenario(work, args.trees, args.files)
+        for phase in ["converge", "steady"]:
+            print(f"running {phase}...", flush=True)
+            elapsed = _run_once(scenario_file, args.timeout)
+            if elapsed is None:
+                # stdout is still redirected by the hung run, which can't be
+                # interrupted
+                print(
+                    f"FAILED: {phase} didn't complete in {args.timeout} seconds",
+                    file=sys.stderr,
+                    flush=True,
+                )
+                os._exit(1)
+            print(f"{phase} completed in {elapsed:.2f} seconds")
+    return 0
+
+
+def _run_once(scenario_file, timeout):
+    # returns the elapsed seconds, None if the run didn't complete in time
+    r = runner.Runner(
+        scenario_file=scenario_file,
+        locations="local://",
+        rehearsal=False,
+        _debug=False,
+    )
+    results = []
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            results.extend(r.run())
+        results.append(output.getvalue())
+
+    start = time.perf_counter()
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join(timeout)
+    if t.is_alive():
+        return None
+    elapsed = time.perf_counter() - start
+    output = results.pop()
+    for result in results:
+        if result.failure is not None or result.errors:
+            print(output)
+            raise RuntimeError(f"run failed on '{result.location}'")
+    return elapsed
+
+
+def write_scenario(work, trees, files):
+    user = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    directories = []
+    for t in range(trees):
+        source = os.path.join(work, "sources", f"tree{t}")
+        for i in range(files):
+            d = os.path.join(source, f"dir{i % 20}")
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"file-with-a-longish-name-{i}.txt"), "w") as f:
+                f.write(f"tree {t} file {i}\n")
+        directories.append(
+            {
+                "path": os.path.join(work, "target", f"tree{t}"),
+                "source": source,
+                "user": user,
+                "group": group,
+                "mode": "644",
+                "purge": True,
+            }
+        )
+    path = os.path.join(work, "scenario.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump({"directories": directories}, f)
+    return path
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+"""Stand-in for python-apt, with just enough of it for the agent.
+
+Every package exists. Installed packages are kept in a dpkg status file,
+var/lib/dpkg/status under the working directory, i.e. the simulated host's
+root. Operations take as long as the STAGEHAND_BENCH_* delays (in seconds)
+in the environment.
+"""
+
+from . import cache
+from . import progress
@@ -0,0 +1,72 @@
+import os
+import time
+
+_STATUS = "var/lib/dpkg/status"
+
+
+def _delay(name):
+    seconds = float(os.environ.get(f"STAGEHAND_BENCH_{name}", "0"))
+    if seconds:
+        time.sleep(seconds)
+
+
+class Package:
+    def __init__(self, cache, name):
+        self._cache = cache
+        self.name = name
+
+    @property
+    def is_installed(self):
+        return self.name in self._cache._installed
+
+    def mark_install(self):
+        self._cache._changes[self.name] = True
+
+    def mark_delete(self):
+        self._cache._changes[self.name] = False
+
+
+class Cache:
+    def __init__(self, progress=None):
+        self.open(progress)
+
+    def open(self, progress=None):
+        _delay("APT_OPEN")
+        self._installed = set()
+        try:
+            with open(_STATUS, "r") as f:
+                for line in f:
+                    if line.startswith("Package: "):
+                        self._installed.add(line[9:].strip())
+        except FileNotFoundError:
+            pass
+        self._changes = {}
+
+    def close(self):
+        pass
+
+    def update(self, fetch_progress=None):
+        _delay("APT_UPDATE")
+
+    def commit(self, fetch_progress=None, install_progress=None):
+        _delay("APT_COMMIT")
+        for name, install in self._changes.items():
+            _delay("DPKG_PACKAGE")
+            if install:
+                self._installed.add(name)
+            else:
+                self._installed.discard(name)
+        os.makedirs(os.path.dirname(_STATUS), exist_ok=True)
+        with open(_STATUS, "w") as f:
+            for name in sorted(self._installed):
+                f.write(
+                    f"Package: {name}\nStatus: install ok installed\nVersion: 1.0\n\n"
+                )
+        self._changes = {}
+        return True
+
+    def __contains__(self, name):
+        return True
+
+    def __getitem__(self, name):
+        return Package(self, name)
@@ -0,0 +1,50 @@
+"""Stand-in for dbus-python talking to systemd, for the agent.
+
+Restart jobs complete STAGEHAND_BENCH_RESTART seconds after they're queued.
+There's no main loop support, so the agent polls for job completion.
+"""
+
+import itertools
+import os
+import time
+
+from . import exceptions
+
+_jobs = {}
+_job_ids = itertools.count(1)
+
+
+def SystemBus():
+    return _Bus()
+
+
+def Interface(obj, dbus_interface):
+    return _Manager()
+
+
+class _Bus:
+    def get_object(self, bus_name, object_path):
+        return _Object(object_path)
+
+
+class _Object:
+    def __init__(self, path):
+        self.path = path
+
+    def Get(self, interface_name, property_name, dbus_interface=None):
+        if self.path.startswith("/org/freedesktop/systemd1/job/"):
+            if time.perf_counter() >= _jobs[self.path]:
+                raise exceptions.DBusException("Unknown object")
+            return "running"
+        return "active"
+
+
+class _Manager:
+    def RestartUnit(self, name, mode):
+        job = f"/org/freedesktop/systemd1/job/{next(_job_ids)}"
+        delay = float(os.environ.get("STAGEHAND_BENCH_RESTART", "0"))
+        _jobs[job] = time.perf_counter() + delay
+        return job
+
+    def GetUnit(self, name):
+        return f"/org/freedesktop/systemd1/unit/{name.replace('.', '_2e')}"
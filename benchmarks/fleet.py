@@ -0,0 +1,300 @@
+"""Fleet benchmark: stagehand against simulated hosts on localhost.
+
+Every simulated host is a directory served by a local SSH stand-in (see
+sshd.py), behind a proxy that adds network latency (see latency.py). The
+real agent runs on them, with fake apt and dbus modules that take as long
+as they're told to. Each scenario size is run against each number of hosts
+twice: once to converge fresh hosts, and again once they're converged.
+
+    python -m benchmarks.fleet [--hosts 1,10,100] [--sizes 10x5x2] ...
+
+Results can be saved as a baseline, later runs fail if they regress
+against it.
+"""
+
+import argparse
+import contextlib
+import grp
+import io
+import json
+import os
+import os.path
+import pwd
+import sys
+import tempfile
+import time
+
+import paramiko
+import yaml
+
+from stagehand import runner
+
+from . import latency
+from . import sshd
+
+_FAKE_MODULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake")
+_DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark stagehand against simulated hosts on localhost"
+    )
+    parser.add_argument(
+        "--hosts",
+        type=_int_list,
+        help="Comma-separated numbers of hosts to run against (1 to 500)",
+        default=[1, 10, 50],
+    )
+    parser.add_argument(
+        "--sizes",
+        type=_size_list,
+        help="Comma-separated scenario sizes, as FILESxPACKAGESxRESTARTS",
+        default=[(10, 5, 2), (100, 20, 5)],
+    )
+    parser.add_argument(
+        "--file-size", type=int, help="Bytes per managed file", default=4096
+    )
+    parser.add_argument(
+        "--rtt-ms", type=float, help="Network round trip time to add", default=20.0
+    )
+    parser.add_argument(
+        "--apt-open", type=float, help="Seconds to open the apt cache", default=0.2
+    )
+    parser.add_argument(
+        "--apt-update", type=float, help="Seconds for 'apt update'", default=1.0
+    )
+    parser.add_argument(
+        "--apt-commit", type=float, help="Seconds per apt commit", default=0.5
+    )
+    parser.add_argument(
+        "--dpkg-package",
+        type=float,
+        help="Seconds per package installed or removed",
+        default=0.05,
+    )
+    parser.add_argument(
+        "--restart", type=float, help="Seconds per service restart", default=0.2
+    )
+    parser.add_argument(
+        "--parallel", type=int, help="Hosts executed concurrently", default=64
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=["none", "zlib", "lzma", "auto"],
+        default="none",
+    )
+    parser.add_argument("--agent-apply", action="store_true", default=False)
+    parser.add_argument("--hash-cache", action="store_true", default=False)
+    parser.add_argument("--agent-workers", type=int, default=1)
+    parser.add_argument("--state-manifest", action="store_true", default=False)
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help=f"Baseline to compare against (default: {_DEFAULT_BASELINE})",
+        default=_DEFAULT_BASELINE,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the results as the baseline instead of comparing against it",
+        default=False,
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="How much worse than the baseline a result can be (default: 0.2)",
+        default=0.2,
+    )
+    args = parser.parse_args()
+    for hosts in args.hosts:
+        if not 1 <= hosts <= 500:
+            parser.error("--hosts must be between 1 and 500")
+
+    results = run(args)
+    _print_results(results)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"benchmarks": results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline saved to '{args.baseline}'")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at '{args.baseline}', nothing to compare against")
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)["benchmarks"]
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print(f"REGRESSION: {r}")
+    return 1 if regressions else 0
+
+
+def run(args):
+    env = {
+        "PYTHONPATH": _FAKE_MODULES,
+        "STAGEHAND_BENCH_APT_OPEN": str(args.apt_open),
+        "STAGEHAND_BENCH_APT_UPDATE": str(args.apt_update),
+        "STAGEHAND_BENCH_APT_COMMIT": str(args.apt_commit),
+        "STAGEHAND_BENCH_DPKG_PACKAGE": str(args.dpkg_package),
+        "STAGEHAND_BENCH_RESTART": str(args.restart),
+    }
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="stagehand-bench-") as work:
+        key = paramiko.RSAKey.generate(2048)
+        key_file = os.path.join(work, "id_rsa")
+        key.write_private_key_file(key_file)
+        server = sshd.Server(
+            hosts_dir=os.path.join(work, "hosts"), host_key=key, env=env
+        )
+        proxy = latency.Proxy(target_port=server.port, rtt=args.rtt_ms / 1000)
+        try:
+            for size in args.sizes:
+                scenario_file = os.path.join(work, "scenario.yaml")
+                write_scenario(scenario_file, size, args.file_size)
+                for hosts in args.hosts:
+                    server.reset_hosts()
+                    for phase in ["converge", "steady"]:
+                        name = f"{'x'.join(map(str, size))}/{hosts}h/{phase}"
+                        print(f"running {name}...", flush=True)
+                        results[name] = _run_once(
+                            args, scenario_file, hosts, proxy, key_file
+                        )
+        finally:
+            proxy.close()
+            server.close()
+    return results
+
+
+def _run_once(args, scenario_file, hosts, proxy, key_file):
+    locations = [f"host{i}@127.0.0.1:{proxy.port}" for i in range(hosts)]
+    r = runner.Runner(
+        scenario_file=scenario_file,
+        locations=",".join(locations),
+        rehearsal=False,
+        _debug=False,
+        parallel=min(args.parallel, hosts),
+        agent_apply=args.agent_apply,
+        # relative paths in the scenario are relative to the agent's
+        # working directory, the host's root; only exec bootstraps there
+        bootstrap="exec",
+        compression=args.compression,
+        hash_cache="var/cache/stagehand/hashes.json" if args.hash_cache else None,
+        agent_workers=args.agent_workers,
+        dpkg_admindir="var/lib/dpkg",
+        state_manifest=(
+            "var/cache/stagehand/manifest.json" if args.state_manifest else None
+        ),
+        auth="key",
+        identity_file=key_file,
+    )
+    proxy.reset_counters()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        location_results = r.run()
+    elapsed = time.perf_counter() - start
+    for result in location_results:
+        if result.failure is not None or result.errors:
+            print(output.getvalue())
+            raise RuntimeError(f"benchmark run failed on '{result.location}'")
+
+    latencies = sorted(result.elapsed_seconds for result in location_results)
+    return {
+        "hosts_per_second": round(hosts / elapsed, 3),
+        "p50_seconds": _percentile(latencies, 50),
+        "p90_seconds": _percentile(latencies, 90),
+        "p99_seconds": _percentile(latencies, 99),
+        "round_trips_per_host": round(proxy.round_trips / hosts, 1),
+    }
+
+
+def write_scenario(path, size, file_size):
+    files, packages, restarts = size
+    user = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    services = [f"bench-svc{i}" for i in range(restarts)]
+
+    def restarts_for(i):
+        return [services[i % len(services)]] if services else []
+
+    d = {
+        "files": [
+            {
+                # relative, see _run_once
+                "path": f"bench-file{i}.conf",
+                "action": "copy",
+                "user": user,
+                "group": group,
+                "mode": "644",
+                "content": (f"# file {i}\n" + "x" * file_size)[:file_size],
+                "restarts": restarts_for(i),
+            }
+            for i in range(files)
+        ],
+        "packages": [
+            {"name": f"bench-pkg{i}", "action": "install", "restarts": restarts_for(i)}
+            for i in range(packages)
+        ],
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        yaml.safe_dump(d, f)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["hosts_per_second"] < base["hosts_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['hosts_per_second']} hosts/s,"
+                f" baseline {base['hosts_per_second']}"
+            )
+        # with a little slack, timings of very quick runs are noisy
+        for key in ["p50_seconds", "p90_seconds", "p99_seconds"]:
+            if result[key] > base[key] * (1 + tolerance) + 0.05:
+                regressions.append(f"{name}: {key} {result[key]}, baseline {base[key]}")
+        key = "round_trips_per_host"
+        if result[key] > base[key] * (1 + tolerance):
+            regressions.append(f"{name}: {key} {result[key]}, baseline {base[key]}")
+    return regressions
+
+
+def _print_results(results):
+    width = max(len(name) for name in results)
+    print(
+        f"{'benchmark':<{width}}  {'hosts/s':>8}  {'p50':>7}  {'p90':>7}"
+        f"  {'p99':>7}  {'round trips':>11}"
+    )
+    for name, r in results.items():
+        print(
+            f"{name:<{width}}  {r['hosts_per_second']:>8.2f}"
+            f"  {r['p50_seconds']:>6.2f}s  {r['p90_seconds']:>6.2f}s"
+            f"  {r['p99_seconds']:>6.2f}s  {r['round_trips_per_host']:>11.1f}"
+        )
+
+
+def _percentile(values, p):
+    # nearest rank, values are sorted
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(index)]
+
+
+def _int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def _size_list(s):
+    sizes = [tuple(int(n) for n in size.split("x")) for size in s.split(",")]
+    if any(len(size) != 3 for size in sizes):
+        raise ValueError(s)
+    return sizes
+
+
+if __name__ == "__main__":
+    sys.exit(main())
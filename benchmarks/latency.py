@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+
+class Proxy:
+    """A TCP proxy on localhost that adds latency to every connection.
+
+    Data in each direction is delivered half the round trip time after it
+    arrives, without limiting throughput. Round trips are counted as the
+    number of times the client sends after hearing from the server, i.e. the
+    times it had to wait on the network.
+    """
+
+    def __init__(self, *, target_port, rtt):
+        self.target_port = target_port
+        self.delay = rtt / 2
+        self.round_trips = 0
+        self.connections = 0
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,))
+        self._thread.start()
+        started.wait()
+
+    def reset_counters(self):
+        self.round_trips = 0
+        self.connections = 0
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, "127.0.0.1", 0)
+        )
+        self.port = server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+        server.close()
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+    async def _handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(
+            "127.0.0.1", self.target_port
+        )
+        self.connections += 1
+        # whoever sent last, a new round trip starts when the client sends
+        # after the server
+        state = {"last": "server"}
+        try:
+            await asyncio.gather(
+                self._pump(client_reader, server_writer, state, "client"),
+                self._pump(server_reader, client_writer, state, "server"),
+            )
+        except asyncio.CancelledError:
+            # closing the proxy with connections still open
+            client_writer.close()
+            server_writer.close()
+
+    async def _pump(self, reader, writer, state, side):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data = await reader.read(64 * 1024)
+            except ConnectionError:
+                data = b""
+            if not data:
+                loop.call_later(self.delay, writer.close)
+                return
+            if side == "client" and state["last"] == "server":
+                self.round_trips += 1
+            state["last"] = side
+            loop.call_later(self.delay, writer.write, data)
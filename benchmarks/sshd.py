@@ -0,0 +1,198 @@
+import logging
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+
+class Server:
+    """A local SSH server standing in for a fleet of hosts.
+
+    The username picks the simulated host: each has its own root directory
+    under hosts_dir, which exec'd commands run in and SFTP paths are
+    relative to. Any password or key is accepted. Commands run for real,
+    with env added to their environment.
+    """
+
+    def __init__(self, *, hosts_dir, host_key, env=None):
+        self.hosts_dir = hosts_dir
+        self.host_key = host_key
+        self.env = dict(os.environ, **(env or {}))
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(1024)
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+        self._lock = threading.Lock()
+        # clients going away mid-session aren't worth reporting
+        logging.getLogger("benchmarks.sshd").setLevel(logging.CRITICAL)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def host_root(self, host):
+        return os.path.join(self.hosts_dir, host)
+
+    def reset_hosts(self):
+        shutil.rmtree(self.hosts_dir, ignore_errors=True)
+        os.makedirs(self.hosts_dir)
+
+    def close(self):
+        self._sock.close()
+        with self._lock:
+            for t in self._transports:
+                t.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            t = paramiko.Transport(conn)
+            t.set_log_channel("benchmarks.sshd")
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTPServer)
+            t.start_server(server=_ServerInterface(self))
+            with self._lock:
+                self._transports = [x for x in self._transports if x.is_active()]
+                self._transports.append(t)
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+        self.root = None
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+    def check_auth_password(self, username, password):
+        return self._login(username)
+
+    def check_auth_publickey(self, username, key):
+        return self._login(username)
+
+    def _login(self, username):
+        self.root = self.server.host_root(username)
+        os.makedirs(self.root, exist_ok=True)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_UNKNOWN_TYPE
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=_exec, args=(channel, command.decode(), self.root, self.server.env)
+        ).start()
+        return True
+
+
+def _exec(channel, command, cwd, env):
+    proc = subprocess.Popen(
+        command,
+        shell=True,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    pumps = [
+        threading.Thread(target=_pump_stdin, args=(channel, proc.stdin)),
+        threading.Thread(target=_pump_out, args=(proc.stdout, channel.sendall)),
+        threading.Thread(target=_pump_out, args=(proc.stderr, channel.sendall_stderr)),
+    ]
+    for p in pumps:
+        p.start()
+    status = proc.wait()
+    for p in pumps[1:]:
+        p.join()
+    channel.send_exit_status(status)
+    channel.close()
+
+
+def _pump_stdin(channel, stdin):
+    try:
+        while True:
+            data = channel.recv(64 * 1024)
+            if not data:
+                break
+            stdin.write(data)
+            stdin.flush()
+    except (OSError, EOFError):
+        pass
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def _pump_out(out, send):
+    try:
+        while True:
+            data = os.read(out.fileno(), 64 * 1024)
+            if not data:
+                break
+            send(data)
+    except (OSError, EOFError):
+        pass
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    # just enough SFTP for putting files, confined to the host's root
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.root
+
+    def _path(self, path):
+        return os.path.join(self.root, os.path.normpath("/" + path).lstrip("/"))
+
+    def open(self, path, flags, attr):
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        try:
+            f = os.fdopen(os.open(self._path(path), flags, 0o644), mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = self._path(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
@@ -18,6 +18,7 @@ setuptools.setup(
     },
     python_requires=">=3.6",
     install_requires=[
+        "cryptography>=2.5",
         "paramiko>=2.7.2,<3.0",
         "PyYAML>=5.4.1,<6.0",
         "wheel>=0.36.2",
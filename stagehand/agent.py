@@ -1,105 +1,215 @@
+import concurrent.futures
+import contextlib
 import hashlib
 import json
 import grp
 import os
 import os.path
 import pwd
+import stat as stat_module
 import sys
+import tarfile
+import threading
+import time
 import traceback
+import zlib
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+_APT_LISTS_DIR = "/var/lib/apt/lists"
+_HASH_CHUNK_SIZE = 1024 * 1024
+# files changed this recently aren't put in the hash cache or the state
+# manifest, see _recently_changed
+_HASH_CACHE_MIN_AGE_NS = 2 * 10 ** 9
+# bump whenever what the state manifest records changes, so manifests
+# written before aren't trusted
+_MANIFEST_VERSION = 1
+
+_COMPRESSION = ["zlib", "lzma"] if lzma is not None else ["zlib"]
+
+# commands that only touch the files at their path(s), they can run on the
+# worker pool; see _submit
+_FILE_COMMANDS = [
+    "file-get-props",
+    "file-get-props-batch",
+    "file-get-signature",
+    "file-patch",
+    "file-write",
+    "file-set-props",
+    "file-delete",
+]
+
+# how long to wait for restart jobs to complete, same as systemd's default
+# start timeout
+_SERVICE_RESTART_TIMEOUT = 90
 
 _rehearsal = False
 _apt_updated = False
+# one apt cache is kept open for the whole session, see _get_cache
+_apt_cache = None
+# skip "apt update" if the package lists are newer than this many minutes,
+# None means always update (once per session)
+_apt_update_max_age = None
+# path of the file hashes are cached in between sessions, None disables the
+# cache; see _hash_file
+_hash_cache_path = None
+_hash_cache = None
+_hash_cache_dirty = False
+_stats = {"hash_cache_hits": 0, "hash_cache_misses": 0}
+# guards the hash cache and stats, which worker threads share
+_lock = threading.Lock()
+# where dpkg keeps its database, the "status" file in particular
+_dpkg_admindir = "/var/lib/dpkg"
+# when set, responses carry how long the agent spent on the command and on
+# the slow parts of it (apt, dpkg), see _timed
+_report_timings = False
+_spans = []
+# one system bus connection is kept for the whole session, see _get_systemd
+_systemd = None
+# job path -> (job result, time), filled in by the JobRemoved signal
+_jobs_removed = {}
+# when bootstrapped without a working directory ("--no-logs"), dpkg output
+# is discarded and errors go to stderr
+_dpkg_log = "dpkg.log"
+_error_log = "error.txt"
+# threads for file commands, None when configured with a single worker;
+# responses are sent from them as they complete, see _submit
+_pool = None
+_send_lock = threading.Lock()
+# path -> future of the last file command submitted on it
+_path_ops = {}
+_outstanding = []
 
 
 def _recv_msg():
-    msg_len = int(sys.stdin.read(10))
-    if msg_len == 0:
-        return
-
-    msg = ""
-    while msg_len - len(msg) > 0:
-        msg += sys.stdin.read(msg_len)
-    return msg
+    return commands.read_frame(sys.stdin.buffer)
 
 
 def _send_msg(msg):
-    msg_len = f"{len(msg):10}"
-    sys.stdout.write(msg_len + msg)
-    sys.stdout.flush()
+    frame = commands.pack_frame(msg)
+    with _send_lock:
+        sys.stdout.buffer.write(frame)
+        sys.stdout.buffer.flush()
 
 
 def _install_package(package):
-    global _apt_updated
+    return _install_packages([package])[0]
 
-    cache = apt.cache.Cache()
-    if not _apt_updated:
-        cache.update()
-        _apt_updated = True
-    cache.open()
 
-    if package not in cache:
-        return _result("error", "package not found")
-    pkg = cache[package]
-    if pkg.is_installed:
-        return _result("noop")
+def _install_packages(packages):
+    cache = _get_cache()
+    _update_cache(cache)
+    return _commit_packages(cache, packages, install=True)
 
-    try:
 
-        class LogInstallProgress(apt.progress.base.InstallProgress):
-            def fork(self):
-                pid = os.fork()
-                if pid == 0:
-                    logfd = os.open(
-                        "dpkg.log", os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644
-                    )
-                    os.dup2(logfd, 1)
-                    os.dup2(logfd, 2)
-                return pid
+def _remove_package(package):
+    return _remove_packages([package])[0]
 
-        if not _rehearsal:
-            pkg.mark_install()
-            cache.commit(install_progress=LogInstallProgress())
 
-        return _result("ok")
-    except Exception as e:
-        return _result("error", str(e))
-    finally:
-        cache.close()
+def _remove_packages(packages):
+    cache = _get_cache()
+    return _commit_packages(cache, packages, install=False)
 
 
-def _remove_package(package):
-    cache = apt.cache.Cache()
-    cache.open()
+def _get_cache():
+    global _apt_cache
 
-    if package not in cache:
-        return _result("error", "package not found")
-    pkg = cache[package]
-    if pkg.is_installed == False:
-        return _result("noop")
+    if _apt_cache is None:
+        with _timed("apt-cache-open"):
+            _apt_cache = apt.cache.Cache()
+    return _apt_cache
+
+
+def _close_cache():
+    global _apt_cache
+
+    if _apt_cache is not None:
+        _apt_cache.close()
+        _apt_cache = None
+
+
+def _update_cache(cache):
+    global _apt_updated
 
+    if _apt_updated or _rehearsal:
+        return
+    _apt_updated = True
+    if _apt_update_max_age is not None:
+        if _apt_lists_age() < _apt_update_max_age * 60:
+            return
+    with _timed("apt-update"):
+        cache.update()
+        cache.open()
+
+
+def _apt_lists_age():
+    # seconds since the package lists were last refreshed
+    newest = 0
     try:
+        with os.scandir(_APT_LISTS_DIR) as entries:
+            for entry in entries:
+                if entry.name != "lock" and entry.is_file():
+                    newest = max(newest, entry.stat().st_mtime)
+    except FileNotFoundError:
+        pass
+    return time.time() - newest
 
-        class LogInstallProgress(apt.progress.base.InstallProgress):
-            def fork(self):
-                pid = os.fork()
-                if pid == 0:
-                    logfd = os.open(
-                        "dpkg.log", os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644
-                    )
-                    os.dup2(logfd, 1)
-                    os.dup2(logfd, 2)
-                return pid
 
-        if not _rehearsal:
-            pkg.mark_delete()
-            cache.commit(install_progress=LogInstallProgress())
+def _commit_packages(cache, packages, install):
+    # mark every package that needs changing, then commit them all in a
+    # single dpkg transaction; returns a result per package, in order
+    results = {}
+    marked = []
+    for package in packages:
+        if package in results:
+            continue
+        if package not in cache:
+            results[package] = _result("error", "package not found")
+        elif cache[package].is_installed == install:
+            results[package] = _result("noop")
+        else:
+            marked.append(package)
 
-        return _result("ok")
+    try:
+        if marked and not _rehearsal:
+            for package in marked:
+                if install:
+                    cache[package].mark_install()
+                else:
+                    cache[package].mark_delete()
+            with _timed("apt-commit"):
+                cache.commit(install_progress=_log_install_progress())
+        for package in marked:
+            results[package] = _result("ok")
     except Exception as e:
-        return _result("error", str(e))
+        for package in marked:
+            results[package] = _result("error", str(e))
     finally:
-        cache.close()
+        # the cache is only reopened (re-reading the dpkg status) after a
+        # commit, or to drop the marks of one that failed
+        if marked and not _rehearsal:
+            with _timed("apt-cache-open"):
+                cache.open()
+
+    return [results[package] for package in packages]
+
+
+def _log_install_progress():
+    class LogInstallProgress(apt.progress.base.InstallProgress):
+        def fork(self):
+            pid = os.fork()
+            if pid == 0:
+                logfd = os.open(
+                    _dpkg_log, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644
+                )
+                os.dup2(logfd, 1)
+                os.dup2(logfd, 2)
+            return pid
+
+    return LogInstallProgress()
 
 
 def _delete_file(path):
@@ -116,17 +226,352 @@ def _delete_file(path):
 
 
 def _get_file_props(path):
+    empty = {"hash": "", "user": "", "group": "", "mode": 0}
     if not os.path.isfile(path):
-        return _result("ok", data={"hash": "", "user": "", "group": "", "mode": 0})
+        return _result("ok", data=empty)
+
+    try:
+        hsh, stat = _hash_file(path)
+        user = pwd.getpwuid(stat.st_uid)[0]
+        group = grp.getgrgid(stat.st_gid)[0]
+        mode = oct(stat.st_mode)[-3:] # keep perms, throw away the rest
+        return _result("ok", data={"hash": hsh, "user": user, "group": group, "mode": mode})
+    except Exception as e:
+        return _result("error", error=str(e), data=empty)
+
+
+def _hash_file(path):
+    """Return (blake2b hex digest, os.stat_result) of the file at path.
+
+    The file is hashed in fixed-size chunks. With the hash cache enabled, a
+    file whose (device, inode, size, mtime, ctime) hasn't changed since it
+    was last hashed isn't read at all.
+    """
+    global _hash_cache_dirty
 
     with open(path, "rb") as f:
-        data = f.read()
-    hsh = hashlib.blake2b(data).hexdigest()
-    stat = os.stat(path)
-    user = pwd.getpwuid(stat.st_uid)[0]
-    group = grp.getgrgid(stat.st_gid)[0]
-    mode = oct(stat.st_mode)[-3:] # keep perms, throw away the rest
-    return _result("ok", data={"hash": hsh, "user": user, "group": group, "mode": mode})
+        stat = os.fstat(f.fileno())
+        key = _stat_key(stat)
+        with _lock:
+            cache = _load_hash_cache()
+            if cache is not None:
+                entry = cache.get(path)
+                if entry is not None and entry[0] == key:
+                    _stats["hash_cache_hits"] += 1
+                    return entry[1], stat
+                _stats["hash_cache_misses"] += 1
+
+        hasher = hashlib.blake2b()
+        buf = bytearray(_HASH_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+        hsh = hasher.hexdigest()
+
+    if cache is not None and not _recently_changed(stat):
+        with _lock:
+            cache[path] = [key, hsh]
+            _hash_cache_dirty = True
+    return hsh, stat
+
+
+def _stat_key(stat):
+    return [
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    ]
+
+
+def _recently_changed(stat):
+    # a change within the timestamp granularity wouldn't show up in the stat
+    # key, so files changed this recently can't be trusted to it
+    changed_ns = max(stat.st_mtime_ns, stat.st_ctime_ns)
+    return int(time.time() * 10 ** 9) - changed_ns < _HASH_CACHE_MIN_AGE_NS
+
+
+def _load_hash_cache():
+    global _hash_cache
+
+    if _hash_cache is None and _hash_cache_path is not None:
+        try:
+            with open(_hash_cache_path, "r") as f:
+                _hash_cache = json.load(f)
+        except (OSError, ValueError):
+            _hash_cache = {}
+    return _hash_cache
+
+
+def _dpkg_installed_versions():
+    """Return {package: version} of the installed packages.
+
+    A single pass over dpkg's status file, much cheaper than opening the apt
+    cache. Packages count as installed as they do for apt, i.e. in any state
+    but "not-installed" or "config-files".
+    """
+    versions = {}
+    package = version = None
+    installed = False
+    status_path = os.path.join(_dpkg_admindir, "status")
+    with open(status_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if line.startswith("Package: "):
+                package = line[9:].strip()
+            elif line.startswith("Version: "):
+                version = line[9:].strip()
+            elif line.startswith("Status: "):
+                # e.g. "install ok installed", "deinstall ok config-files"
+                installed = line.split()[-1] not in ("not-installed", "config-files")
+            elif line.strip() == "":
+                if package is not None and installed:
+                    versions[package] = version
+                package = version = None
+                installed = False
+    if package is not None and installed:
+        versions[package] = version
+    return versions
+
+
+def _query_packages(packages):
+    try:
+        versions = _dpkg_installed_versions()
+    except Exception as e:
+        return _result("error", error=str(e), data={"results": []})
+    results = [
+        {
+            "package": package,
+            "installed": package in versions,
+            "version": versions.get(package),
+        }
+        for package in packages
+    ]
+    return _result("ok", data={"results": results})
+
+
+def _change_packages(packages, install, versions):
+    # only packages dpkg's status says need changing are handed to apt, so
+    # the cache isn't opened on a converged location; versions is None if
+    # the status couldn't be read, and apt decides for every package
+    changing = [p for p in packages if versions is None or (p in versions) != install]
+    results = {}
+    if changing:
+        if install:
+            results = dict(zip(changing, _install_packages(changing)))
+        else:
+            results = dict(zip(changing, _remove_packages(changing)))
+    return [results.get(p, _result("noop")) for p in packages]
+
+
+def _resource_state(resource, dpkg_versions):
+    # what a resource looks like on the location: the stat key of a file,
+    # the installed version of a package, None if it doesn't exist
+    kind, _, name = resource.partition(":")
+    if kind == "file":
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            return None
+        if _recently_changed(stat):
+            raise _RacyState()
+        return _stat_key(stat)
+    return dpkg_versions().get(name)
+
+
+class _RacyState(Exception):
+    pass
+
+
+def _lazy(fn):
+    # fn is called at most once, and only if needed
+    value = []
+
+    def get():
+        if not value:
+            value.append(fn())
+        return value[0]
+
+    return get
+
+
+def _check_manifest(path, resources):
+    """Return the resources that are unchanged since the manifest was written.
+
+    resources is {resource: fingerprint} of the desired state; a resource is
+    unchanged if both its desired state and its state on the location are
+    the same as they were.
+    """
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return _result("ok", data={"unchanged": []})
+    except (OSError, ValueError) as e:
+        return _result("error", error=f"can't read state manifest: {e}")
+    if manifest.get("version") != _MANIFEST_VERSION:
+        # written by another version of the agent, everything's checked and
+        # it's rewritten after a clean run
+        return _result("ok", data={"unchanged": []})
+
+    recorded = manifest["resources"]
+    dpkg_versions = _lazy(_dpkg_installed_versions)
+    unchanged = []
+    try:
+        for resource, fingerprint in resources.items():
+            r = recorded.get(resource)
+            if r is None or r["desired"] != fingerprint:
+                continue
+            try:
+                if r["state"] == _resource_state(resource, dpkg_versions):
+                    unchanged.append(resource)
+            except _RacyState:
+                pass
+    except Exception as e:
+        return _result("error", error=str(e))
+    return _result("ok", data={"unchanged": unchanged})
+
+
+def _write_manifest(path, resources):
+    if _rehearsal:
+        return _result("ok")
+    dpkg_versions = _lazy(_dpkg_installed_versions)
+    try:
+        recorded = {}
+        for resource, fingerprint in resources.items():
+            try:
+                state = _resource_state(resource, dpkg_versions)
+            except _RacyState:
+                # left out, so it's checked in full next time
+                continue
+            recorded[resource] = {"desired": fingerprint, "state": state}
+        manifest = {"version": _MANIFEST_VERSION, "resources": recorded}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        return _result("error", error=str(e))
+    return _result("ok")
+
+
+def _save_hash_cache():
+    # a rehearsal leaves nothing behind on the location, the cache included
+    if _hash_cache is None or not _hash_cache_dirty or _rehearsal:
+        return
+    try:
+        os.makedirs(os.path.dirname(_hash_cache_path), exist_ok=True)
+        tmp_path = f"{_hash_cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(_hash_cache, f)
+        os.replace(tmp_path, _hash_cache_path)
+    except Exception as e:
+        # losing the cache only costs a re-hash next time
+        _log_error(e)
+
+
+def _get_file_props_batch(paths):
+    results = []
+    for path in paths:
+        result = _get_file_props(path)
+        results.append(_file_get_props_response(path, result).__dict__)
+    return results
+
+
+def _package_responses(resp_cls, packages, results):
+    return [
+        resp_cls(
+            package=package,
+            result=result["result"],
+            error=result["error"],
+        ).__dict__
+        for package, result in zip(packages, results)
+    ]
+
+
+def _service_responses(services, results):
+    return [
+        commands.ServiceRestartResponse(
+            service=service,
+            result=result["result"],
+            error=result["error"],
+            duration=result["data"].get("duration", 0.0),
+        ).__dict__
+        for service, result in zip(services, results)
+    ]
+
+
+def _file_get_props_response(path, result):
+    return commands.FileGetPropsResponse(
+        path=path,
+        result=result["result"],
+        error=result["error"],
+        hash=result["data"]["hash"],
+        user=result["data"]["user"],
+        group=result["data"]["group"],
+        mode=result["data"]["mode"],
+    )
+
+
+def _get_file_signature(path, block_size):
+    # weak/strong checksums for each full block, must match delta.py
+    signatures = []
+    if not os.path.isfile(path):
+        return _result("ok", data={"signatures": signatures})
+
+    try:
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if len(block) < block_size:
+                    break
+                strong = hashlib.blake2b(block, digest_size=16).hexdigest()
+                signatures.append([zlib.adler32(block), strong])
+        return _result("ok", data={"signatures": signatures})
+    except Exception as e:
+        return _result("error", error=str(e), data={"signatures": []})
+
+
+def _patch_file(path, block_size, delta, hsh):
+    if not os.path.isfile(path):
+        return _result("error", error="file not found")
+
+    # rebuild into a temporary file with the original's owner and mode, and
+    # only rename it over the original once the hash checks out
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.stagehand"
+    )
+    try:
+        stat = os.stat(path)
+        hasher = hashlib.blake2b()
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            for op in delta:
+                if op[0] == "copy":
+                    src.seek(op[1] * block_size)
+                    for _ in range(op[2]):
+                        data = src.read(block_size)
+                        hasher.update(data)
+                        dst.write(data)
+                else:
+                    data = op[1]
+                    hasher.update(data)
+                    dst.write(data)
+        if hasher.hexdigest() != hsh:
+            os.remove(tmp_path)
+            return _result("error", error="patched file hash mismatch")
+        os.chown(tmp_path, stat.st_uid, stat.st_gid)
+        os.chmod(tmp_path, stat.st_mode & 0o7777)
+        os.replace(tmp_path, path)
+        return _result("ok")
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return _result("error", error=str(e))
 
 
 def _set_file_props(path, user, group, mode):
@@ -150,26 +595,451 @@ def _set_file_props(path, user, group, mode):
         return _result("error", error=str(e))
 
 def _restart_service(service):
+    return _restart_services([service])[0]
+
+
+def _restart_services(services):
+    """Restart services concurrently, over a single D-Bus connection.
+
+    Every restart job is queued before waiting on any of them. Each result
+    has the seconds the restart took in data["duration"].
+    """
+    if _rehearsal:
+        return [_result("ok", data={"duration": 0.0}) for svc in services]
+
     try:
-        if not _rehearsal:
-            bus = dbus.SystemBus()
-            systemd = bus.get_object(
-                "org.freedesktop.systemd1", "/org/freedesktop/systemd1"
+        bus, manager = _get_systemd()
+    except Exception as e:
+        return [_result("error", error=str(e)) for svc in services]
+
+    results = {}
+    # job path -> (service, unit, start)
+    jobs = {}
+    for svc in services:
+        unit = f"{svc}.service"
+        start = time.perf_counter()
+        try:
+            job = str(manager.RestartUnit(unit, "replace"))
+            jobs[job] = (svc, unit, start)
+        except Exception as e:
+            results[svc] = _result("error", error=str(e))
+
+    removed = _wait_for_jobs(bus, manager, jobs, _SERVICE_RESTART_TIMEOUT)
+    for job, (svc, unit, start) in jobs.items():
+        if job not in removed:
+            results[svc] = _result(
+                "error",
+                error=f"restart didn't complete in {_SERVICE_RESTART_TIMEOUT} seconds",
+                data={"duration": round(time.perf_counter() - start, 3)},
             )
-            manager = dbus.Interface(systemd, "org.freedesktop.systemd1.Manager")
-            manager.RestartUnit(f"{service}.service", "replace")
+            continue
+        job_result, finished = removed[job]
+        data = {"duration": round(finished - start, 3)}
+        if job_result == "done":
+            results[svc] = _result("ok", data=data)
+        else:
+            results[svc] = _result("error", error=f"restart {job_result}", data=data)
+    return [results[svc] for svc in services]
+
+
+def _get_systemd():
+    global _systemd
+    if _systemd is None:
+        if GLib is not None:
+            # signals are only delivered through a main loop
+            DBusGMainLoop(set_as_default=True)
+        bus = dbus.SystemBus()
+        systemd = bus.get_object(
+            "org.freedesktop.systemd1", "/org/freedesktop/systemd1"
+        )
+        manager = dbus.Interface(systemd, "org.freedesktop.systemd1.Manager")
+        if GLib is not None:
+            manager.connect_to_signal("JobRemoved", _on_job_removed)
+            manager.Subscribe()
+        _systemd = (bus, manager)
+    return _systemd
+
+
+def _on_job_removed(job_id, job, unit, result):
+    _jobs_removed[str(job)] = (str(result), time.perf_counter())
+
+
+def _wait_for_jobs(bus, manager, jobs, timeout):
+    """Wait for systemd jobs to be removed, i.e. complete, until timeout.
+
+    Returns {job: (job result, time)} for the jobs that completed. Without
+    GLib there's no way to receive the JobRemoved signal, so the jobs are
+    polled instead.
+    """
+    deadline = time.perf_counter() + timeout
+    removed = {}
+    if GLib is not None:
+        context = GLib.MainContext.default()
+        # wakes the loop up regularly to check the deadline
+        tick = GLib.timeout_add(100, lambda: True)
+        try:
+            while time.perf_counter() < deadline:
+                for job in jobs:
+                    if job in _jobs_removed:
+                        removed[job] = _jobs_removed.pop(job)
+                if len(removed) == len(jobs):
+                    break
+                context.iteration(True)
+        finally:
+            GLib.source_remove(tick)
+            # JobRemoved is signalled for every job, not just ours
+            _jobs_removed.clear()
+        return removed
+
+    while len(removed) < len(jobs) and time.perf_counter() < deadline:
+        for job, (svc, unit, start) in jobs.items():
+            if job not in removed:
+                job_result = _poll_job(bus, manager, job, unit)
+                if job_result is not None:
+                    removed[job] = (job_result, time.perf_counter())
+        if len(removed) < len(jobs):
+            time.sleep(0.1)
+    return removed
+
+
+def _poll_job(bus, manager, job, unit):
+    # the job object goes away when the job completes; the unit's state
+    # then tells whether it succeeded
+    try:
+        bus.get_object("org.freedesktop.systemd1", job).Get(
+            "org.freedesktop.systemd1.Job",
+            "State",
+            dbus_interface="org.freedesktop.DBus.Properties",
+        )
+        return None
+    except dbus.exceptions.DBusException:
+        pass
+    state = bus.get_object("org.freedesktop.systemd1", manager.GetUnit(unit)).Get(
+        "org.freedesktop.systemd1.Unit",
+        "ActiveState",
+        dbus_interface="org.freedesktop.DBus.Properties",
+    )
+    return "done" if state == "active" else str(state)
+
+
+def _write_file(path, chunks, user, group, mode):
+    # write next to the destination and rename over it, so the file is
+    # never seen half-written or with the wrong owner/mode
+    uid = pwd.getpwnam(user)[2]
+    gid = grp.getgrnam(group)[2]
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.stagehand"
+    )
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chown(tmp_path, uid, gid)
+        os.chmod(tmp_path, int(mode, 8))
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _write_compressed_file(path, content, compression, user, group, mode):
+    try:
+        if not _rehearsal:
+            _write_file(path, _decompress(content, compression), user, group, mode)
+    except Exception as e:
+        return _result("error", error=str(e))
+    return _get_file_props(path)
+
+
+def _decompress(data, compression):
+    # decompressed in chunks, straight to the file
+    if compression == "none":
+        yield data
+        return
+    if compression == "zlib":
+        decompressor = zlib.decompressobj()
+    elif compression == "lzma" and lzma is not None:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"unsupported compression: {compression}")
+    for i in range(0, len(data), 64 * 1024):
+        yield decompressor.decompress(data[i : i + 64 * 1024])
+    if compression == "zlib":
+        yield decompressor.flush()
+
+
+def _copy_file(path, content, compression, hsh, user, group, mode):
+    props = _get_file_props(path)
+    if props["result"] == "error":
+        return props
+    data = props["data"]
+    if (
+        data["hash"] == hsh
+        and data["user"] == user
+        and data["group"] == group
+        and data["mode"] == mode
+    ):
+        return _result("noop")
+
+    if _rehearsal:
         return _result("ok")
+
+    try:
+        if data["hash"] != hsh:
+            _write_file(path, _decompress(content, compression), user, group, mode)
+        else:
+            result = _set_file_props(path, user, group, mode)
+            if result["result"] == "error":
+                return result
     except Exception as e:
         return _result("error", error=str(e))
 
+    # check again
+    data = _get_file_props(path)["data"]
+    if data["hash"] != hsh:
+        return _result("error", error="couldn't copy file")
+    if data["user"] != user or data["group"] != group or data["mode"] != mode:
+        return _result("error", error="couldn't modify file props")
+    return _result("ok")
+
+
+def _apply_scenario(scn, send, deferred_restarts=[]):
+    """Converge the whole scenario locally, in the same order as the client.
+
+    Calls send(kind, resource, action, result) as each resource completes.
+    Services in deferred_restarts aren't restarted, they're sent with a
+    "deferred" result for the client to restart.
+    """
+    restarts = []
+
+    def done(kind, resource, action, result, resource_restarts=[]):
+        send(kind, resource, action, result)
+        if result["result"] == "ok":
+            for r in resource_restarts:
+                if r not in restarts:
+                    restarts.append(r)
+
+    versions = None
+    if scn["packages"]:
+        try:
+            versions = _dpkg_installed_versions()
+        except Exception as e:
+            _log_error(e)
+
+    # 1. package installs
+    installs = [pkg for pkg in scn["packages"] if pkg["action"] == "install"]
+    if installs:
+        results = _change_packages([pkg["name"] for pkg in installs], True, versions)
+        for pkg, result in zip(installs, results):
+            done("package", pkg["name"], "install", result, pkg["restarts"])
+
+    # 2. package removes
+    removes = [pkg for pkg in scn["packages"] if pkg["action"] == "remove"]
+    if removes:
+        results = _change_packages([pkg["name"] for pkg in removes], False, versions)
+        for pkg, result in zip(removes, results):
+            done("package", pkg["name"], "remove", result, pkg["restarts"])
+
+    # 3. file copies
+    copies = [f for f in scn["files"] if f["action"] == "copy"]
+
+    def copy(f):
+        return _copy_file(
+            f["path"],
+            f["content"],
+            f["compression"],
+            f["hash"],
+            f["user"],
+            f["group"],
+            f["mode"],
+        )
+
+    for f, result in _map_files(copy, copies):
+        done("file", f["path"], "copy", result, f["restarts"])
+
+    # 4. file deletes
+    deletes = [f for f in scn["files"] if f["action"] == "delete"]
+    for f, result in _map_files(lambda f: _delete_file(f["path"]), deletes):
+        done("file", f["path"], "delete", result, f["restarts"])
+
+    # 5. restarts
+    for svc in restarts:
+        if svc in deferred_restarts:
+            send("service", svc, "restart", _result("deferred"))
+    restarts = [svc for svc in restarts if svc not in deferred_restarts]
+    if restarts:
+        results = _restart_services(restarts)
+        for svc, result in zip(restarts, results):
+            done("service", svc, "restart", result)
+
+
+def _map_files(fn, files):
+    # yields (f, fn(f)) for each file, as they complete when there's a pool
+    if _pool is None:
+        for f in files:
+            yield f, fn(f)
+        return
+    futures = {_pool.submit(fn, f): f for f in files}
+    for future in concurrent.futures.as_completed(futures):
+        yield futures[future], future.result()
+
+
+def _diff_directory(path, entries, user, group, mode, purge):
+    """Compare the files under path with entries of [relative path, size, hash].
+
+    Files are hashed only if their size matches. Returns data with the
+    relative paths that are changed (missing or different content), only
+    need their props set, and aren't managed (only when purging).
+    """
+    try:
+        uid = pwd.getpwnam(user)[2]
+        gid = grp.getgrnam(group)[2]
+    except KeyError as e:
+        return _result("error", error=f"no such user/group: {e}")
+
+    def check(entry):
+        rel, size, hsh = entry
+        try:
+            target = _directory_path(path, rel)
+            stat = os.lstat(target)
+            if not stat_module.S_ISREG(stat.st_mode) or stat.st_size != size:
+                return "changed"
+            if _hash_file(target)[0] != hsh:
+                return "changed"
+        except FileNotFoundError:
+            return "changed"
+        if stat.st_uid != uid or stat.st_gid != gid:
+            return "props"
+        if not _mode_equals(mode, stat.st_mode):
+            return "props"
+        return None
+
+    data = {"changed": [], "props": [], "unmanaged": []}
+    try:
+        for entry, state in _map_files(check, entries):
+            if state is not None:
+                data[state].append(entry[0])
+        if purge and os.path.isdir(path):
+            managed = set(entry[0] for entry in entries)
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in filenames:
+                    rel = os.path.relpath(os.path.join(dirpath, name), path)
+                    if rel not in managed:
+                        data["unmanaged"].append(rel)
+    except Exception as e:
+        return _result("error", error=str(e))
+    return _result("ok", data=data)
+
+
+def _sync_directory(path, archive, compression, user, group, mode, props, delete):
+    """Extract the archive of changed files under path, and set props/delete.
+
+    Only regular files are extracted, and nothing outside path is written
+    to, whatever the archive's paths or symlinks under path say.
+    """
+    if _rehearsal:
+        return _result("ok")
+
+    try:
+        os.makedirs(path, exist_ok=True)
+        if archive:
+            _extract_archive(path, archive, compression, user, group, mode)
+        for rel in props:
+            target = _directory_path(path, rel)
+            os.chown(target, pwd.getpwnam(user)[2], grp.getgrnam(group)[2])
+            os.chmod(target, int(mode, 8))
+        for rel in delete:
+            os.remove(_directory_path(path, rel))
+    except Exception as e:
+        return _result("error", error=str(e))
+    return _result("ok")
+
+
+class _ChunkReader:
+    # a file object reading from an iterator of bytes chunks
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._chunk = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos == len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._pos = 0
+                if self._chunk is None:
+                    self._chunk = b""
+                    break
+                continue
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._pos + size)
+                size -= end - self._pos
+            parts.append(self._chunk[self._pos : end])
+            self._pos = end
+        return b"".join(parts)
+
+
+def _extract_archive(path, archive, compression, user, group, mode):
+    # streamed: decompressed and extracted a chunk at a time
+    stream = _ChunkReader(_decompress(archive, compression))
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                raise ValueError(f"not a regular file in archive: {member.name}")
+            target = _directory_path(path, member.name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # checked again, now that the parents exist
+            target = _directory_path(path, member.name)
+            f = tar.extractfile(member)
+            chunks = iter(lambda: f.read(_HASH_CHUNK_SIZE), b"")
+            _write_file(target, chunks, user, group, mode)
+
+
+def _directory_path(root, rel):
+    # rel joined to root, refusing anything that ends up outside of root:
+    # absolute paths, "..", or a parent directory that's a symlink out
+    path = os.path.normpath(os.path.join(root, rel))
+    real_root = os.path.realpath(root)
+    parent = os.path.realpath(os.path.dirname(path))
+    inside = parent == real_root or parent.startswith(os.path.join(real_root, ""))
+    if os.path.isabs(rel) or not inside:
+        raise ValueError(f"path outside of '{root}': {rel}")
+    return path
+
 
 def _result(result, error="", data={}):
     return {"result": result, "error": error, "data": data}
 
 
-def _run():
-    global _rehearsal
+@contextlib.contextmanager
+def _timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _report_timings:
+            _spans.append([name, start, time.perf_counter() - start])
+
 
+def _timings(received):
+    # span starts are made relative to when the command was received
+    timings = {
+        "agent": round(time.perf_counter() - received, 6),
+        "spans": [
+            [name, round(start - received, 6), round(duration, 6)]
+            for name, start, duration in _spans
+        ],
+    }
+    del _spans[:]
+    return timings
+
+
+def _run():
     sys.stdout.write("OK")
     sys.stdout.flush()
 
@@ -177,72 +1047,354 @@ def _run():
         msg = _recv_msg()
         if msg is None or msg == "BYE":
             break
+        received = time.perf_counter()
 
-        d = json.loads(msg)
-        cmd = commands.fromdict(d)
+        cmd = commands.fromdict(msg)
 
-        if cmd.name == "rehearsal-start":
-            _rehearsal = True
-            cmd_resp = commands.RehearsalStartResponse(result="ok", error="")
-        elif cmd.name == "package-install":
-            result = _install_package(cmd.package)
-            cmd_resp = commands.PackageInstallResponse(
-                package=cmd.package,
-                result=result["result"],
-                error=result["error"],
-            )
-        elif cmd.name == "package-remove":
-            result = _remove_package(cmd.package)
-            cmd_resp = commands.PackageRemoveResponse(
-                package=cmd.package,
-                result=result["result"],
-                error=result["error"],
-            )
-        elif cmd.name == "file-get-props":
-            result = _get_file_props(cmd.path)
-            cmd_resp = commands.FileGetPropsResponse(
-                path=cmd.path,
-                result=result["result"],
-                error=result["error"],
-                hash=result["data"]["hash"],
-                user=result["data"]["user"],
-                group=result["data"]["group"],
-                mode=result["data"]["mode"],
-            )
-        elif cmd.name == "file-set-props":
-            result = _set_file_props(cmd.path, cmd.user, cmd.group, cmd.mode)
-            cmd_resp = commands.FileSetPropsResponse(
-                path=cmd.path,
-                result=result["result"],
-                error=result["error"],
-            )
-        elif cmd.name == "file-delete":
-            result = _delete_file(cmd.path)
-            cmd_resp = commands.FileDeleteResponse(
-                path=cmd.path,
-                result=result["result"],
-                error=result["error"],
+        if _pool is not None and cmd.name in _FILE_COMMANDS:
+            _submit(cmd, received)
+            continue
+        # everything else runs on its own, once file commands before it
+        # have completed
+        _drain()
+        _respond(cmd, _handle(cmd), received)
+
+    _drain()
+    _close_cache()
+    _save_hash_cache()
+
+    sys.stdout.write("OK")
+    sys.stdout.flush()
+
+
+def _submit(cmd, received):
+    """Run a file command on the pool, it responds when it completes.
+
+    Commands on the same path run in the order they were received. A
+    file-get-props-batch is split into a command per path, and responded to
+    once they've all completed.
+    """
+    if cmd.name == "file-get-props-batch":
+        parts = [_schedule([path], _get_file_props, path) for path in cmd.paths]
+
+        def handle():
+            results = [
+                _part_response(path, part).__dict__
+                for path, part in zip(cmd.paths, parts)
+            ]
+            return commands.FileGetPropsBatchResponse(
+                results=results, result="ok", error=""
             )
-        elif cmd.name == "service-restart":
-            result = _restart_service(cmd.service)
-            cmd_resp = commands.ServiceRestartResponse(
-                service=cmd.service,
+
+        # the parts were submitted first, see _schedule
+        future = _pool.submit(handle)
+        _outstanding.append(future)
+    else:
+        future = _schedule([cmd.path], _handle, cmd)
+
+    def respond(future):
+        # the request is answered even if the command raised, the client is
+        # waiting on it
+        try:
+            cmd_resp = future.result()
+        except Exception as e:
+            _log_error(e)
+            cmd_resp = _error_response(cmd, e)
+        _respond(cmd, cmd_resp, received)
+
+    future.add_done_callback(respond)
+
+
+def _part_response(path, part):
+    # a path of a file-get-props-batch, failing on its own if it raised
+    try:
+        return _file_get_props_response(path, part.result())
+    except Exception as e:
+        _log_error(e)
+        return _error_response(commands.FileGetProps(path=path), e)
+
+
+def _error_response(cmd, e):
+    # the response to a file command that raised
+    error = str(e) or type(e).__name__
+    if cmd.name == "file-get-props-batch":
+        # each path fails, so the client reports every one of them
+        results = [
+            _error_response(commands.FileGetProps(path=path), e).__dict__
+            for path in cmd.paths
+        ]
+        return commands.FileGetPropsBatchResponse(
+            results=results, result="error", error=error
+        )
+    if cmd.name == "file-get-signature":
+        return commands.FileGetSignatureResponse(
+            path=cmd.path, result="error", error=error, block_size=0, signatures=[]
+        )
+    if cmd.name in ["file-get-props", "file-write"]:
+        response = (
+            commands.FileGetPropsResponse
+            if cmd.name == "file-get-props"
+            else commands.FileWriteResponse
+        )
+        return response(
+            path=cmd.path,
+            result="error",
+            error=error,
+            hash="",
+            user="",
+            group="",
+            mode="",
+        )
+    response = {
+        "file-patch": commands.FilePatchResponse,
+        "file-set-props": commands.FileSetPropsResponse,
+        "file-delete": commands.FileDeleteResponse,
+    }[cmd.name]
+    return response(path=cmd.path, result="error", error=error)
+
+
+def _schedule(paths, fn, *args):
+    # fn(*args) runs on the pool once the commands before it on the same
+    # paths have completed. The pool's queue is first in first out, so those
+    # have already been picked up by a thread and waiting on them can't
+    # deadlock it
+    before = [_path_ops[path] for path in paths if path in _path_ops]
+
+    def run():
+        concurrent.futures.wait(before)
+        return fn(*args)
+
+    future = _pool.submit(run)
+    for path in paths:
+        _path_ops[path] = future
+    _outstanding.append(future)
+    return future
+
+
+def _drain():
+    # waits for every command on the pool, anything they raised has been
+    # answered with an error response
+    concurrent.futures.wait(_outstanding)
+    del _outstanding[:]
+    _path_ops.clear()
+
+
+def _respond(cmd, cmd_resp, received):
+    if _report_timings:
+        cmd_resp.timings = _timings(received)
+    _send_response(cmd, cmd_resp)
+
+
+def _handle(cmd):
+    global _rehearsal
+    global _apt_update_max_age
+    global _hash_cache_path
+    global _dpkg_admindir
+    global _report_timings
+    global _pool
+
+    if cmd.name == "rehearsal-start":
+        _rehearsal = True
+        cmd_resp = commands.RehearsalStartResponse(result="ok", error="")
+    elif cmd.name == "configure":
+        _apt_update_max_age = cmd.apt_update_max_age
+        _hash_cache_path = cmd.hash_cache
+        if cmd.dpkg_admindir is not None:
+            _dpkg_admindir = cmd.dpkg_admindir
+        _report_timings = cmd.report_timings
+        if cmd.workers > 1 and _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(max_workers=cmd.workers)
+        cmd_resp = commands.ConfigureResponse(
+            result="ok", error="", compression=_COMPRESSION
+        )
+    elif cmd.name == "check-manifest":
+        result = _check_manifest(cmd.path, cmd.resources)
+        cmd_resp = commands.CheckManifestResponse(
+            result=result["result"],
+            error=result["error"],
+            unchanged=result["data"].get("unchanged", []),
+        )
+    elif cmd.name == "write-manifest":
+        result = _write_manifest(cmd.path, cmd.resources)
+        cmd_resp = commands.WriteManifestResponse(
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "agent-stats":
+        cmd_resp = commands.AgentStatsResponse(
+            result="ok", error="", stats=dict(_stats)
+        )
+    elif cmd.name == "package-install":
+        result = _install_package(cmd.package)
+        cmd_resp = commands.PackageInstallResponse(
+            package=cmd.package,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "package-remove":
+        result = _remove_package(cmd.package)
+        cmd_resp = commands.PackageRemoveResponse(
+            package=cmd.package,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "package-install-batch":
+        results = _install_packages(cmd.packages)
+        cmd_resp = commands.PackageInstallBatchResponse(
+            results=_package_responses(
+                commands.PackageInstallResponse, cmd.packages, results
+            ),
+            result="ok",
+            error="",
+        )
+    elif cmd.name == "package-remove-batch":
+        results = _remove_packages(cmd.packages)
+        cmd_resp = commands.PackageRemoveBatchResponse(
+            results=_package_responses(
+                commands.PackageRemoveResponse, cmd.packages, results
+            ),
+            result="ok",
+            error="",
+        )
+    elif cmd.name == "package-query-batch":
+        result = _query_packages(cmd.packages)
+        cmd_resp = commands.PackageQueryBatchResponse(
+            results=result["data"]["results"],
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "file-get-props":
+        result = _get_file_props(cmd.path)
+        cmd_resp = _file_get_props_response(cmd.path, result)
+    elif cmd.name == "file-get-props-batch":
+        results = _get_file_props_batch(cmd.paths)
+        cmd_resp = commands.FileGetPropsBatchResponse(
+            results=results,
+            result="ok",
+            error="",
+        )
+    elif cmd.name == "file-get-signature":
+        result = _get_file_signature(cmd.path, cmd.block_size)
+        cmd_resp = commands.FileGetSignatureResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+            block_size=cmd.block_size,
+            signatures=result["data"]["signatures"],
+        )
+    elif cmd.name == "file-patch":
+        result = _patch_file(cmd.path, cmd.block_size, cmd.delta, cmd.hash)
+        cmd_resp = commands.FilePatchResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "file-write":
+        result = _write_compressed_file(
+            cmd.path, cmd.content, cmd.compression, cmd.user, cmd.group, cmd.mode
+        )
+        cmd_resp = commands.FileWriteResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+            hash=result["data"].get("hash", ""),
+            user=result["data"].get("user", ""),
+            group=result["data"].get("group", ""),
+            mode=result["data"].get("mode", 0),
+        )
+    elif cmd.name == "file-set-props":
+        result = _set_file_props(cmd.path, cmd.user, cmd.group, cmd.mode)
+        cmd_resp = commands.FileSetPropsResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "file-delete":
+        result = _delete_file(cmd.path)
+        cmd_resp = commands.FileDeleteResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "directory-diff":
+        result = _diff_directory(
+            cmd.path, cmd.entries, cmd.user, cmd.group, cmd.mode, cmd.purge
+        )
+        cmd_resp = commands.DirectoryDiffResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+            changed=result["data"].get("changed", []),
+            props=result["data"].get("props", []),
+            unmanaged=result["data"].get("unmanaged", []),
+        )
+    elif cmd.name == "directory-sync":
+        result = _sync_directory(
+            cmd.path,
+            cmd.archive,
+            cmd.compression,
+            cmd.user,
+            cmd.group,
+            cmd.mode,
+            cmd.props,
+            cmd.delete,
+        )
+        cmd_resp = commands.DirectorySyncResponse(
+            path=cmd.path,
+            result=result["result"],
+            error=result["error"],
+        )
+    elif cmd.name == "service-restart":
+        result = _restart_service(cmd.service)
+        cmd_resp = commands.ServiceRestartResponse(
+            service=cmd.service,
+            result=result["result"],
+            error=result["error"],
+            duration=result["data"].get("duration", 0.0),
+        )
+    elif cmd.name == "service-restart-batch":
+        results = _restart_services(cmd.services)
+        cmd_resp = commands.ServiceRestartBatchResponse(
+            results=_service_responses(cmd.services, results),
+            result="ok",
+            error="",
+        )
+    elif cmd.name == "apply-scenario":
+        if cmd.rehearsal:
+            _rehearsal = True
+
+        def send(kind, resource, action, result, cmd=cmd):
+            resource_resp = commands.ApplyScenarioResult(
+                kind=kind,
+                resource=resource,
+                action=action,
                 result=result["result"],
                 error=result["error"],
             )
-        else:
-            raise Exception(f"Unknown command: {cmd.name}")
+            _send_response(cmd, resource_resp)
 
-        d = cmd_resp.__dict__
-        j = json.dumps(d)
-        _send_msg(j)
+        try:
+            _apply_scenario(cmd.scenario, send, cmd.deferred_restarts)
+            cmd_resp = commands.ApplyScenarioResponse(result="ok", error="")
+        except Exception as e:
+            cmd_resp = commands.ApplyScenarioResponse(result="error", error=str(e))
+    else:
+        raise Exception(f"Unknown command: {cmd.name}")
+    return cmd_resp
 
-    sys.stdout.write("OK")
-    sys.stdout.flush()
+
+def _send_response(cmd, cmd_resp):
+    cmd_resp.id = cmd.id
+    _send_msg(cmd_resp.__dict__)
 
 
 def _log_error(e):
-    with open("error.txt", "a") as f:
+    if _error_log is None:
+        sys.stderr.write(str(e))
+        sys.stderr.write(traceback.format_exc())
+        sys.stderr.flush()
+        return
+    with open(_error_log, "a") as f:
         f.write(str(e))
         f.write(traceback.format_exc())
 
@@ -252,11 +1404,21 @@ def _mode_equals(str_mode, int_mode):
 
 
 if __name__ == "__main__":
+    if "--no-logs" in sys.argv[1:]:
+        _dpkg_log = os.devnull
+        _error_log = None
     try:
         import apt
         import dbus
+        import dbus.exceptions
         import commands
 
+        try:
+            from dbus.mainloop.glib import DBusGMainLoop
+            from gi.repository import GLib
+        except ImportError:
+            GLib = None
+
         _run()
     except Exception as e:
         _log_error(e)
@@ -1,7 +1,223 @@
 ########################################################################
 # Note: keep classes flat so dict unpacking (fromdict) continues to work
+#
+# Envelope fields (e.g. the request "id" used to match responses to
+# commands) aren't part of any class, fromdict sets them as attributes
 ########################################################################
 
+import json
+import struct
+
+
+# the request id, and the agent's timings (see Configure.report_timings)
+ENVELOPE = ["id", "timings"]
+
+########################################################################
+# Wire format, shared by the client and the agent
+#
+# Each message is a frame: a fixed header, a JSON document and a data
+# section. bytes values anywhere in the message are moved to the data
+# section as-is (not escaped into the JSON) and replaced by a
+# {"$bytes": [offset, length]} reference.
+#
+# Header, big endian: magic (2s), version (B), flags (B, unused),
+# JSON length (I), data length (I)
+########################################################################
+
+FRAME_HEADER = struct.Struct(">2sBBII")
+FRAME_MAGIC = b"SH"
+FRAME_VERSION = 1
+# the most the JSON document and the data section can each hold
+FRAME_MAX_LENGTH = 2 ** 32 - 1
+
+
+def pack_frame(msg):
+    chunks = []
+    data_len = 0
+
+    def default(o):
+        nonlocal data_len
+        if isinstance(o, (bytes, bytearray)):
+            ref = {"$bytes": [data_len, len(o)]}
+            chunks.append(o)
+            data_len += len(o)
+            return ref
+        raise TypeError(f"can't encode {type(o).__name__}")
+
+    j = json.dumps(msg, default=default).encode("utf-8")
+    if len(j) > FRAME_MAX_LENGTH or data_len > FRAME_MAX_LENGTH:
+        raise ValueError(
+            f"message too big for a frame ({len(j)} bytes of JSON, {data_len} bytes of data)"
+        )
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, 0, len(j), data_len)
+    return b"".join([header, j] + chunks)
+
+
+def unpack_frame_header(header):
+    """Return (JSON length, data length) from a frame header."""
+    magic, version, flags, json_len, data_len = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"unsupported frame (magic {magic!r}, version {version})")
+    return json_len, data_len
+
+
+def unpack_frame(j, data):
+    view = memoryview(data)
+
+    def object_hook(d):
+        if len(d) == 1 and "$bytes" in d:
+            offset, length = d["$bytes"]
+            return bytes(view[offset : offset + length])
+        return d
+
+    return json.loads(j.decode("utf-8"), object_hook=object_hook)
+
+
+def read_frame(f):
+    """Read one frame from the binary file f, returns None at EOF."""
+    header = read_exact(f, FRAME_HEADER.size)
+    if header is None:
+        return None
+    json_len, data_len = unpack_frame_header(header)
+    j = read_exact(f, json_len)
+    data = read_exact(f, data_len)
+    if j is None or data is None:
+        return None
+    return unpack_frame(j, data)
+
+
+def read_exact(f, n):
+    # read straight into a preallocated buffer
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        r = f.readinto(view[pos:])
+        if not r:
+            return None
+        pos += r
+    return buf
+
+
+class Configure:
+    def __init__(
+        self,
+        *,
+        apt_update_max_age=None,
+        hash_cache=None,
+        dpkg_admindir=None,
+        report_timings=False,
+        workers=1,
+        name="configure",
+    ):
+        self.name = name
+        # minutes, see --apt-update-max-age
+        self.apt_update_max_age = apt_update_max_age
+        # path of the agent's file hash cache on the location, or None
+        self.hash_cache = hash_cache
+        # dpkg's database directory on the location, None for the default
+        self.dpkg_admindir = dpkg_admindir
+        # have the agent report its timings in every response, for tracing
+        self.report_timings = report_timings
+        # threads the agent runs file commands on, 1 runs every command in
+        # turn on the main thread
+        self.workers = workers
+
+
+class ConfigureResponse:
+    def __init__(
+        self,
+        *,
+        result,
+        error,
+        compression,
+        name="configure-response",
+    ):
+        self.name = name
+        self.result = result
+        self.error = error
+        # compression formats the agent can decompress, e.g. ["zlib", "lzma"]
+        self.compression = compression
+
+
+class CheckManifest:
+    def __init__(
+        self,
+        *,
+        path,
+        resources,
+        name="check-manifest",
+    ):
+        self.name = name
+        # path of the state manifest on the location
+        self.path = path
+        # {resource: fingerprint} of the desired state, see
+        # Scenario.fingerprints
+        self.resources = resources
+
+
+class CheckManifestResponse:
+    def __init__(
+        self,
+        *,
+        result,
+        error,
+        unchanged,
+        name="check-manifest-response",
+    ):
+        self.name = name
+        self.result = result
+        self.error = error
+        # resources that are the same as when the manifest was written
+        self.unchanged = unchanged
+
+
+class WriteManifest:
+    def __init__(
+        self,
+        *,
+        path,
+        resources,
+        name="write-manifest",
+    ):
+        self.name = name
+        self.path = path
+        self.resources = resources
+
+
+class WriteManifestResponse:
+    def __init__(
+        self,
+        *,
+        result,
+        error,
+        name="write-manifest-response",
+    ):
+        self.name = name
+        self.result = result
+        self.error = error
+
+
+class AgentStats:
+    def __init__(self, *, name="agent-stats"):
+        self.name = name
+
+
+class AgentStatsResponse:
+    def __init__(
+        self,
+        *,
+        result,
+        error,
+        stats,
+        name="agent-stats-response",
+    ):
+        self.name = name
+        self.result = result
+        self.error = error
+        # counters, e.g. {"hash_cache_hits": 10, "hash_cache_misses": 2}
+        self.stats = stats
+
 
 class PackageInstall:
     def __init__(
@@ -55,6 +271,88 @@ class PackageRemoveResponse:
         self.error = error
 
 
+class PackageInstallBatch:
+    def __init__(
+        self,
+        *,
+        packages,
+        name="package-install-batch",
+    ):
+        self.name = name
+        self.packages = packages
+
+
+class PackageInstallBatchResponse:
+    def __init__(
+        self,
+        *,
+        results,
+        result,
+        error,
+        name="package-install-batch-response",
+    ):
+        self.name = name
+        # list of PackageInstallResponse dicts, in the order of packages
+        self.results = results
+        self.result = result
+        self.error = error
+
+
+class PackageRemoveBatch:
+    def __init__(
+        self,
+        *,
+        packages,
+        name="package-remove-batch",
+    ):
+        self.name = name
+        self.packages = packages
+
+
+class PackageRemoveBatchResponse:
+    def __init__(
+        self,
+        *,
+        results,
+        result,
+        error,
+        name="package-remove-batch-response",
+    ):
+        self.name = name
+        # list of PackageRemoveResponse dicts, in the order of packages
+        self.results = results
+        self.result = result
+        self.error = error
+
+
+class PackageQueryBatch:
+    def __init__(
+        self,
+        *,
+        packages,
+        name="package-query-batch",
+    ):
+        self.name = name
+        self.packages = packages
+
+
+class PackageQueryBatchResponse:
+    def __init__(
+        self,
+        *,
+        results,
+        result,
+        error,
+        name="package-query-batch-response",
+    ):
+        self.name = name
+        # list of {"package", "installed", "version"} dicts, in the order of
+        # packages; version is None if the package isn't installed
+        self.results = results
+        self.result = result
+        self.error = error
+
+
 class FileDelete:
     def __init__(
         self,
@@ -115,6 +413,145 @@ class FileGetPropsResponse:
         self.mode = mode
 
 
+class FileGetPropsBatch:
+    def __init__(
+        self,
+        *,
+        paths,
+        name="file-get-props-batch",
+    ):
+        self.name = name
+        self.paths = paths
+
+
+class FileGetPropsBatchResponse:
+    def __init__(
+        self,
+        *,
+        results,
+        result,
+        error,
+        name="file-get-props-batch-response",
+    ):
+        self.name = name
+        # list of FileGetPropsResponse dicts, in the order of paths
+        self.results = results
+        self.result = result
+        self.error = error
+
+
+class FileGetSignature:
+    def __init__(
+        self,
+        *,
+        path,
+        block_size,
+        name="file-get-signature",
+    ):
+        self.name = name
+        self.path = path
+        self.block_size = block_size
+
+
+class FileGetSignatureResponse:
+    def __init__(
+        self,
+        *,
+        path,
+        result,
+        error,
+        block_size,
+        signatures,
+        name="file-get-signature-response",
+    ):
+        self.name = name
+        self.path = path
+        self.result = result
+        self.error = error
+        self.block_size = block_size
+        # [weak, strong] checksums for each full block, see delta.py
+        self.signatures = signatures
+
+
+class FilePatch:
+    def __init__(
+        self,
+        *,
+        path,
+        block_size,
+        delta,
+        hash,
+        name="file-patch",
+    ):
+        self.name = name
+        self.path = path
+        self.block_size = block_size
+        self.delta = delta
+        # hash of the patched file, checked before it replaces the original
+        self.hash = hash
+
+
+class FilePatchResponse:
+    def __init__(
+        self,
+        *,
+        path,
+        result,
+        error,
+        name="file-patch-response",
+    ):
+        self.name = name
+        self.path = path
+        self.result = result
+        self.error = error
+
+
+class FileWrite:
+    def __init__(
+        self,
+        *,
+        path,
+        content,
+        compression,
+        user,
+        group,
+        mode,
+        name="file-write",
+    ):
+        self.name = name
+        self.path = path
+        # bytes of the (compressed) file content
+        self.content = content
+        self.compression = compression
+        self.user = user
+        self.group = group
+        self.mode = mode
+
+
+class FileWriteResponse:
+    def __init__(
+        self,
+        *,
+        path,
+        result,
+        error,
+        hash,
+        group,
+        user,
+        mode,
+        name="file-write-response",
+    ):
+        self.name = name
+        self.path = path
+        self.result = result
+        self.error = error
+        # props of the file once written
+        self.hash = hash
+        self.group = group
+        self.user = user
+        self.mode = mode
+
+
 class FileSetProps:
     def __init__(
         self,
@@ -147,6 +584,96 @@ class FileSetPropsResponse:
         self.error = error
 
 
+class DirectoryDiff:
+    def __init__(
+        self,
+        *,
+        path,
+        entries,
+        user,
+        group,
+        mode,
+        purge,
+        name="directory-diff",
+    ):
+        self.name = name
+        self.path = path
+        # [relative path, size, hash] of every file in the tree
+        self.entries = entries
+        self.user = user
+        self.group = group
+        self.mode = mode
+        # report files under path that aren't in entries
+        self.purge = purge
+
+
+class DirectoryDiffResponse:
+    def __init__(
+        self,
+        *,
+        path,
+        result,
+        error,
+        changed,
+        props,
+        unmanaged,
+        name="directory-diff-response",
+    ):
+        self.name = name
+        self.path = path
+        self.result = result
+        self.error = error
+        # relative paths of files that are missing or have other content
+        self.changed = changed
+        # relative paths of files that only have the wrong user/group/mode
+        self.props = props
+        # relative paths of files that aren't in the entries, if purging
+        self.unmanaged = unmanaged
+
+
+class DirectorySync:
+    def __init__(
+        self,
+        *,
+        path,
+        archive,
+        compression,
+        user,
+        group,
+        mode,
+        props,
+        delete,
+        name="directory-sync",
+    ):
+        self.name = name
+        self.path = path
+        # bytes of a (compressed) tar archive of the changed files, with
+        # paths relative to path; empty if no files changed
+        self.archive = archive
+        self.compression = compression
+        self.user = user
+        self.group = group
+        self.mode = mode
+        # relative paths to set the user/group/mode of, and to delete
+        self.props = props
+        self.delete = delete
+
+
+class DirectorySyncResponse:
+    def __init__(
+        self,
+        *,
+        path,
+        result,
+        error,
+        name="directory-sync-response",
+    ):
+        self.name = name
+        self.path = path
+        self.result = result
+        self.error = error
+
+
 class ServiceRestart:
     def __init__(
         self,
@@ -165,12 +692,42 @@ class ServiceRestartResponse:
         service,
         result,
         error,
+        duration=0.0,
         name="service-restart-response",
     ):
         self.name = name
         self.service = service
         self.result = result
         self.error = error
+        # seconds the restart job took to complete
+        self.duration = duration
+
+
+class ServiceRestartBatch:
+    def __init__(
+        self,
+        *,
+        services,
+        name="service-restart-batch",
+    ):
+        self.name = name
+        self.services = services
+
+
+class ServiceRestartBatchResponse:
+    def __init__(
+        self,
+        *,
+        results,
+        result,
+        error,
+        name="service-restart-batch-response",
+    ):
+        self.name = name
+        # list of ServiceRestartResponse dicts, in the order of services
+        self.results = results
+        self.result = result
+        self.error = error
 
 
 class RehearsalStart:
@@ -185,33 +742,152 @@ class RehearsalStartResponse:
         self.error = error
 
 
+class ApplyScenario:
+    def __init__(
+        self,
+        *,
+        scenario,
+        rehearsal,
+        deferred_restarts=[],
+        name="apply-scenario",
+    ):
+        self.name = name
+        # scenario.Scenario.todict()
+        self.scenario = scenario
+        self.rehearsal = rehearsal
+        # services the client restarts itself, after syncing directories;
+        # they're reported with a "deferred" result instead of restarted
+        self.deferred_restarts = deferred_restarts
+
+
+class ApplyScenarioResult:
+    def __init__(
+        self,
+        *,
+        kind,
+        resource,
+        action,
+        result,
+        error,
+        name="apply-scenario-result",
+    ):
+        self.name = name
+        # one of "package", "file" or "service"
+        self.kind = kind
+        self.resource = resource
+        self.action = action
+        self.result = result
+        self.error = error
+
+
+class ApplyScenarioResponse:
+    def __init__(
+        self,
+        *,
+        result,
+        error,
+        name="apply-scenario-response",
+    ):
+        self.name = name
+        self.result = result
+        self.error = error
+
+
 def fromdict(d):
+    d = dict(d)
+    envelope = {k: d.pop(k, None) for k in ENVELOPE}
     cmd_name = d["name"]
-    if cmd_name == "package-install":
-        return PackageInstall(**d)
+    if cmd_name == "configure":
+        cmd = Configure(**d)
+    elif cmd_name == "configure-response":
+        cmd = ConfigureResponse(**d)
+    elif cmd_name == "check-manifest":
+        cmd = CheckManifest(**d)
+    elif cmd_name == "check-manifest-response":
+        cmd = CheckManifestResponse(**d)
+    elif cmd_name == "write-manifest":
+        cmd = WriteManifest(**d)
+    elif cmd_name == "write-manifest-response":
+        cmd = WriteManifestResponse(**d)
+    elif cmd_name == "agent-stats":
+        cmd = AgentStats(**d)
+    elif cmd_name == "agent-stats-response":
+        cmd = AgentStatsResponse(**d)
+    elif cmd_name == "package-install":
+        cmd = PackageInstall(**d)
     elif cmd_name == "package-install-response":
-        return PackageInstallResponse(**d)
+        cmd = PackageInstallResponse(**d)
     elif cmd_name == "package-remove":
-        return PackageRemove(**d)
+        cmd = PackageRemove(**d)
     elif cmd_name == "package-remove-response":
-        return PackageRemoveResponse(**d)
+        cmd = PackageRemoveResponse(**d)
+    elif cmd_name == "package-install-batch":
+        cmd = PackageInstallBatch(**d)
+    elif cmd_name == "package-install-batch-response":
+        cmd = PackageInstallBatchResponse(**d)
+    elif cmd_name == "package-remove-batch":
+        cmd = PackageRemoveBatch(**d)
+    elif cmd_name == "package-remove-batch-response":
+        cmd = PackageRemoveBatchResponse(**d)
+    elif cmd_name == "package-query-batch":
+        cmd = PackageQueryBatch(**d)
+    elif cmd_name == "package-query-batch-response":
+        cmd = PackageQueryBatchResponse(**d)
     elif cmd_name == "file-get-props":
-        return FileGetProps(**d)
+        cmd = FileGetProps(**d)
     elif cmd_name == "file-get-props-response":
-        return FileGetPropsResponse(**d)
+        cmd = FileGetPropsResponse(**d)
+    elif cmd_name == "file-get-props-batch":
+        cmd = FileGetPropsBatch(**d)
+    elif cmd_name == "file-get-props-batch-response":
+        cmd = FileGetPropsBatchResponse(**d)
+    elif cmd_name == "file-get-signature":
+        cmd = FileGetSignature(**d)
+    elif cmd_name == "file-get-signature-response":
+        cmd = FileGetSignatureResponse(**d)
+    elif cmd_name == "file-patch":
+        cmd = FilePatch(**d)
+    elif cmd_name == "file-patch-response":
+        cmd = FilePatchResponse(**d)
+    elif cmd_name == "file-write":
+        cmd = FileWrite(**d)
+    elif cmd_name == "file-write-response":
+        cmd = FileWriteResponse(**d)
     elif cmd_name == "file-set-props":
-        return FileSetProps(**d)
+        cmd = FileSetProps(**d)
     elif cmd_name == "file-set-props-response":
-        return FileSetPropsResponse(**d)
+        cmd = FileSetPropsResponse(**d)
     elif cmd_name == "file-delete":
-        return FileDelete(**d)
+        cmd = FileDelete(**d)
     elif cmd_name == "file-delete-response":
-        return FileDeleteResponse(**d)
+        cmd = FileDeleteResponse(**d)
+    elif cmd_name == "directory-diff":
+        cmd = DirectoryDiff(**d)
+    elif cmd_name == "directory-diff-response":
+        cmd = DirectoryDiffResponse(**d)
+    elif cmd_name == "directory-sync":
+        cmd = DirectorySync(**d)
+    elif cmd_name == "directory-sync-response":
+        cmd = DirectorySyncResponse(**d)
     elif cmd_name == "service-restart":
-        return ServiceRestart(**d)
+        cmd = ServiceRestart(**d)
     elif cmd_name == "service-restart-response":
-        return ServiceRestartResponse(**d)
+        cmd = ServiceRestartResponse(**d)
+    elif cmd_name == "service-restart-batch":
+        cmd = ServiceRestartBatch(**d)
+    elif cmd_name == "service-restart-batch-response":
+        cmd = ServiceRestartBatchResponse(**d)
     elif cmd_name == "rehearsal-start":
-        return RehearsalStart(**d)
+        cmd = RehearsalStart(**d)
     elif cmd_name == "rehearsal-start-response":
-        return RehearsalStartResponse(**d)
+        cmd = RehearsalStartResponse(**d)
+    elif cmd_name == "apply-scenario":
+        cmd = ApplyScenario(**d)
+    elif cmd_name == "apply-scenario-result":
+        cmd = ApplyScenarioResult(**d)
+    elif cmd_name == "apply-scenario-response":
+        cmd = ApplyScenarioResponse(**d)
+    else:
+        raise ValueError(f"unknown command: {cmd_name}")
+    cmd.__dict__.update(envelope)
+    return cmd
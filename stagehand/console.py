@@ -1,9 +1,17 @@
 import argparse
+import sys
 
+from . import credentials
+from . import history
 from . import runner
+from . import tracing
+from . import scenario
 
 
 def stagehand():
+    if sys.argv[1:2] == ["history"]:
+        return stagehand_history(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description="stagehand - Configuration management done (too) quick"
     )
@@ -16,9 +24,17 @@ def stagehand():
     parser.add_argument(
         "--locations",
         type=str,
-        help="Locations (comma-separated hostnames) to configure, e.g. 'web1.aws.com,web2.aws.com'",
+        help="Locations (comma-separated) to configure, e.g. 'root@web1.aws.com,root@web2.aws.com', 'local://' or 'exec://chroot /srv/image'",
         required=True,
     )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        metavar="PATH",
+        help="Inventory file (YAML) of variables for templated files, for every location and per location",
+        required=False,
+        default=None,
+    )
     parser.add_argument(
         "--rehearsal",
         action="store_true",
@@ -26,6 +42,148 @@ def stagehand():
         required=False,
         default=False,
     )
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        help="Number of locations to execute the scenario against concurrently (per process, with --processes)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of worker processes to shard locations across, each running --parallel of them at once",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--agent-apply",
+        action="store_true",
+        help="Send the whole scenario to the agent and let it converge the location by itself",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=str,
+        choices=["sftp", "exec"],
+        help="How to start the agent: copy it to the location with SFTP, or stream it to a single python3 exec",
+        required=False,
+        default="sftp",
+    )
+    parser.add_argument(
+        "--apt-update-max-age",
+        type=int,
+        metavar="MINUTES",
+        help="Don't refresh the package lists if they were updated less than this many minutes ago (default: always refresh)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=["none", "zlib", "lzma", "auto"],
+        help="Send file content compressed through the agent instead of with SFTP ('auto' picks the best format the location supports)",
+        required=False,
+        default="none",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        type=str,
+        nargs="?",
+        const="/var/cache/stagehand/hashes.json",
+        metavar="PATH",
+        help="Cache file hashes on the location, keyed by inode, size and timestamps, so unchanged files aren't re-read (default path: /var/cache/stagehand/hashes.json)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--agent-workers",
+        type=int,
+        metavar="N",
+        help="Number of threads the agent hashes, writes and deletes files on concurrently (default: 1)",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--state-manifest",
+        type=str,
+        nargs="?",
+        const="/var/cache/stagehand/manifest.json",
+        metavar="PATH",
+        help="Keep a manifest of the state of each resource on the location after a clean run, and skip resources that haven't changed since (default path: /var/cache/stagehand/manifest.json)",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--scenario-cache-dir",
+        type=str,
+        help=f"Where compiled scenarios are cached, so unchanged scenarios aren't parsed again (default: {scenario.default_cache_dir()})",
+        required=False,
+        default=scenario.default_cache_dir(),
+    )
+    parser.add_argument(
+        "--no-scenario-cache",
+        action="store_true",
+        help="Don't use or update the compiled scenario cache",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--auth",
+        type=str,
+        choices=["password", "key"],
+        help="Log into locations with a password (prompted for once per location before execution starts), or with SSH keys/the SSH agent",
+        required=False,
+        default="password",
+    )
+    parser.add_argument(
+        "--identity-file",
+        type=str,
+        help="Private key to authenticate with, in addition to the SSH agent and the default keys",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--credential-store",
+        type=str,
+        nargs="?",
+        const=credentials.default_store_path(),
+        metavar="PATH",
+        help=f"Keep location passwords in an encrypted store, unlocked with a passphrase or ${credentials.PASSPHRASE_ENV} (default path: {credentials.default_store_path()})",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--history-db",
+        type=str,
+        help=f"SQLite database every execution is recorded in (default: {history.default_path()})",
+        required=False,
+        default=history.default_path(),
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="Don't record this execution in the history database",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        metavar="FILE",
+        help="Record where time goes (connecting, bootstrapping the agent, each command's round trip, SFTP transfers, apt on the location) and write it to FILE",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--trace-format",
+        type=str,
+        choices=tracing.FORMATS,
+        help="Write the trace as JSON lines, or in Chrome's trace event format (chrome://tracing, Perfetto)",
+        required=False,
+        default="jsonl",
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -35,10 +193,84 @@ def stagehand():
     )
 
     args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if args.agent_workers < 1:
+        parser.error("--agent-workers must be at least 1")
     r = runner.Runner(
         scenario_file=args.scenario,
         locations=args.locations,
         rehearsal=args.rehearsal,
         _debug=args.debug,
+        inventory_file=args.inventory,
+        parallel=args.parallel,
+        processes=args.processes,
+        agent_apply=args.agent_apply,
+        bootstrap=args.bootstrap,
+        apt_update_max_age=args.apt_update_max_age,
+        compression=args.compression,
+        hash_cache=args.hash_cache,
+        agent_workers=args.agent_workers,
+        scenario_cache_dir=None if args.no_scenario_cache else args.scenario_cache_dir,
+        auth=args.auth,
+        identity_file=args.identity_file,
+        credential_store=args.credential_store,
+        history_db=None if args.no_history else args.history_db,
+        state_manifest=args.state_manifest,
+        trace=args.trace,
+        trace_format=args.trace_format,
+    )
+    results = r.run()
+    # the exit status
+    if any(result.failure is not None or result.errors for result in results):
+        return 1
+    return 0
+
+
+def stagehand_history(argv):
+    parser = argparse.ArgumentParser(
+        prog="stagehand history",
+        description="stagehand history - Report on past executions",
+    )
+    parser.add_argument(
+        "report",
+        type=str,
+        nargs="*",
+        metavar="{hosts,steps,errors}",
+        help="What to report on: the slowest locations, the slowest steps, and/or errors and run times per day (default: all of them)",
+        default=history.REPORTS,
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        help="How many days back to report on",
+        required=False,
+        default=30,
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        help="How many of the slowest locations/steps to report",
+        required=False,
+        default=10,
+    )
+    parser.add_argument(
+        "--history-db",
+        type=str,
+        help=f"SQLite database executions are recorded in (default: {history.default_path()})",
+        required=False,
+        default=history.default_path(),
+    )
+
+    args = parser.parse_args(argv)
+    for report in args.report:
+        if report not in history.REPORTS:
+            parser.error(f"unknown report '{report}'")
+    history.report(
+        args.history_db,
+        days=args.days,
+        limit=args.limit,
+        reports=args.report,
     )
-    r.run()
@@ -0,0 +1,144 @@
+import base64
+import getpass
+import json
+import os
+import os.path
+import tempfile
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from . import transport
+
+PASSPHRASE_ENV = "STAGEHAND_STORE_PASSPHRASE"
+
+
+class Credential:
+    def __init__(self, *, password=None, key_filename=None):
+        self.password = password
+        self.key_filename = key_filename
+
+
+class CredentialStore:
+    """Location passwords, kept encrypted on disk.
+
+    The file holds a random salt and a Fernet token; the key is derived from
+    a passphrase with scrypt, so the store is unlocked once per run.
+    """
+
+    def __init__(self, path, passphrase):
+        self.path = path
+        self.passwords = {}
+        self._dirty = False
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                d = json.load(f)
+            self._salt = base64.b64decode(d["salt"])
+            try:
+                token = self._fernet(passphrase).decrypt(d["token"].encode())
+            except InvalidToken:
+                raise CredentialStoreError(
+                    f"can't unlock credential store '{path}', wrong passphrase?"
+                )
+            self.passwords = json.loads(token)
+        else:
+            self._salt = os.urandom(16)
+        self._key = self._fernet(passphrase)
+
+    def get(self, location):
+        return self.passwords.get(location)
+
+    def set(self, location, password):
+        if self.passwords.get(location) != password:
+            self.passwords[location] = password
+            self._dirty = True
+
+    def forget(self, location):
+        if self.passwords.pop(location, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        token = self._key.encrypt(json.dumps(self.passwords).encode())
+        d = {
+            "version": 1,
+            "salt": base64.b64encode(self._salt).decode(),
+            "token": token.decode(),
+        }
+        store_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(store_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=store_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(d, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def _fernet(self, passphrase):
+        kdf = Scrypt(
+            salt=self._salt,
+            length=32,
+            n=2**15,
+            r=8,
+            p=1,
+            backend=default_backend(),
+        )
+        return Fernet(base64.urlsafe_b64encode(kdf.derive(passphrase.encode())))
+
+
+def default_store_path():
+    config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_home, "stagehand", "credentials")
+
+
+def open_store(path, prompt=getpass.getpass):
+    """Unlock (or create) the credential store at path.
+
+    The passphrase is taken from $STAGEHAND_STORE_PASSPHRASE if it's set, so
+    runs can be completely unattended.
+    """
+    passphrase = os.environ.get(PASSPHRASE_ENV)
+    if passphrase is None:
+        passphrase = ""
+        while passphrase == "":
+            passphrase = prompt(f"passphrase for credential store '{path}': ")
+        if not os.path.exists(path):
+            if prompt("repeat passphrase: ") != passphrase:
+                raise CredentialStoreError("passphrases don't match")
+    return CredentialStore(path, passphrase)
+
+
+def resolve(locations, *, auth, store=None, key_filename=None, prompt=getpass.getpass):
+    """Return a Credential for each location, before anything is executed.
+
+    With auth "key" no passwords are needed: the SSH agent and keys are used.
+    With auth "password" passwords come from the store when it has them and
+    are otherwise prompted for, once per location. Locations that aren't
+    reached over SSH need neither.
+    """
+    creds = {}
+    for loc in locations:
+        if auth == "key" or not transport.uses_ssh(loc):
+            creds[loc] = Credential(key_filename=key_filename)
+            continue
+
+        password = store.get(loc) if store is not None else None
+        while not password:
+            password = prompt(f"password for '{loc}': ")
+        creds[loc] = Credential(password=password, key_filename=key_filename)
+    return creds
+
+
+def update_store(store, creds, auth_failed):
+    # only passwords that worked are kept
+    for loc, cred in creds.items():
+        if loc in auth_failed:
+            store.forget(loc)
+        elif cred.password is not None:
+            store.set(loc, cred.password)
+    store.save()
+
+
+class CredentialStoreError(Exception):
+    pass
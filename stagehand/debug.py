@@ -7,6 +7,10 @@ def set_debug(debug):
     _debug = debug
 
 
+def enabled():
+    return _debug
+
+
 def print(msg):
     if _debug:
         _print(f"\n[DEBUG] {msg}")
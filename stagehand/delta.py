@@ -0,0 +1,99 @@
+import hashlib
+import zlib
+
+
+# rsync-style delta encoding. The agent signs every full block of the file
+# it already has with a weak checksum (Adler-32, cheap to roll one byte at a
+# time) and a strong one (blake2b); the client slides a window over the new
+# content looking for blocks the agent already has, and sends only the bytes
+# in between.
+#
+# A delta is a list of operations:
+#   ["copy", first_block, block_count] - blocks from the existing file
+#   ["data", bytes]                    - literal bytes
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 64 * 1024
+
+_ADLER_MOD = 65521
+
+
+def block_size(size):
+    # roughly sqrt(size), so the signature and the delta stay small
+    bs = 1 << (int(size**0.5).bit_length())
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, bs))
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def compute(data, block_size, signatures, limit=None):
+    """Return (delta, literal_bytes) to turn the signed file into data.
+
+    Returns None if more than limit literal bytes would be needed, i.e. the
+    delta isn't worth sending.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((index, strong))
+
+    delta = []
+    literal_bytes = 0
+    literal_start = 0
+    pos = 0
+    end = len(data) - block_size
+    a = b = 0
+    if pos <= end:
+        a, b = _adler32(data[pos : pos + block_size])
+
+    while pos <= end:
+        index = None
+        candidates = table.get((b << 16) | a)
+        if candidates is not None:
+            strong = strong_checksum(data[pos : pos + block_size])
+            for i, s in candidates:
+                if s == strong:
+                    index = i
+                    break
+
+        if index is not None:
+            if literal_start < pos:
+                delta.append(_data_op(data[literal_start:pos]))
+                literal_bytes += pos - literal_start
+            if delta and delta[-1][0] == "copy" and sum(delta[-1][1:]) == index:
+                delta[-1][2] += 1
+            else:
+                delta.append(["copy", index, 1])
+            pos += block_size
+            literal_start = pos
+            if pos <= end:
+                a, b = _adler32(data[pos : pos + block_size])
+            continue
+
+        if limit is not None and literal_bytes + pos - literal_start > limit:
+            return None
+
+        # roll the window forward one byte
+        if pos < end:
+            out_byte = data[pos]
+            in_byte = data[pos + block_size]
+            a = (a - out_byte + in_byte) % _ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+        pos += 1
+
+    if literal_start < len(data):
+        literal_bytes += len(data) - literal_start
+        if limit is not None and literal_bytes > limit:
+            return None
+        delta.append(_data_op(data[literal_start:]))
+    return delta, literal_bytes
+
+
+def _adler32(block):
+    checksum = zlib.adler32(block)
+    return checksum & 0xFFFF, checksum >> 16
+
+
+def _data_op(data):
+    return ["data", data]
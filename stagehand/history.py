@@ -0,0 +1,158 @@
+import os
+import os.path
+import sqlite3
+import time
+
+REPORTS = ["hosts", "steps", "errors"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    scenario_file TEXT NOT NULL,
+    scenario_hash TEXT NOT NULL,
+    location TEXT NOT NULL,
+    rehearsal INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    errors INTEGER NOT NULL,
+    failure TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    seq INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    result TEXT NOT NULL,
+    error TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS steps_run_id ON steps (run_id);
+"""
+
+
+class Step:
+    __slots__ = ("command", "resource", "result", "error", "duration")
+
+    def __init__(self, *, command, resource, result, error, duration):
+        self.command = command
+        self.resource = resource
+        self.result = result
+        self.error = error
+        self.duration = duration
+
+
+class History:
+    """Execution history, kept in a SQLite database.
+
+    Each location a scenario is executed against is a run, made of the steps
+    taken. A run and all its steps are written in a single transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_SCHEMA)
+
+    def record(self, *, scenario_file, scenario_hash, rehearsal, result):
+        with self._db:
+            cur = self._db.execute(
+                "INSERT INTO runs (scenario_file, scenario_hash, location, rehearsal,"
+                " started_at, finished_at, errors, failure)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    scenario_file,
+                    scenario_hash,
+                    result.location,
+                    int(rehearsal),
+                    result.started_at,
+                    result.finished_at,
+                    result.errors,
+                    result.failure,
+                ),
+            )
+            self._db.executemany(
+                "INSERT INTO steps (run_id, seq, command, resource, result, error,"
+                " duration) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        cur.lastrowid,
+                        seq,
+                        step.command,
+                        step.resource,
+                        step.result,
+                        step.error,
+                        step.duration,
+                    )
+                    for seq, step in enumerate(result.steps)
+                ],
+            )
+
+    def slowest_hosts(self, *, since, limit):
+        return self._db.execute(
+            "SELECT location, COUNT(*), AVG(finished_at - started_at),"
+            " MAX(finished_at - started_at)"
+            " FROM runs WHERE started_at >= ?"
+            " GROUP BY location ORDER BY 3 DESC LIMIT ?",
+            (since, limit),
+        ).fetchall()
+
+    def slowest_steps(self, *, since, limit):
+        return self._db.execute(
+            "SELECT steps.command, steps.resource, COUNT(*), AVG(steps.duration),"
+            " MAX(steps.duration)"
+            " FROM steps JOIN runs ON runs.id = steps.run_id"
+            " WHERE runs.started_at >= ?"
+            " GROUP BY steps.command, steps.resource ORDER BY 4 DESC LIMIT ?",
+            (since, limit),
+        ).fetchall()
+
+    def error_trend(self, *, since):
+        # per day: runs, failed runs, errors, and how long runs took
+        return self._db.execute(
+            "SELECT date(started_at, 'unixepoch', 'localtime'), COUNT(*),"
+            " SUM(failure IS NOT NULL), SUM(errors), AVG(finished_at - started_at)"
+            " FROM runs WHERE started_at >= ?"
+            " GROUP BY 1 ORDER BY 1",
+            (since,),
+        ).fetchall()
+
+    def close(self):
+        self._db.close()
+
+
+def default_path():
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    return os.path.join(data_home, "stagehand", "history.db")
+
+
+def report(path, *, days=30, limit=10, reports=REPORTS):
+    if not os.path.exists(path):
+        print(f"no execution history in '{path}'")
+        return
+    h = History(path)
+    since = time.time() - days * 24 * 60 * 60
+    try:
+        if "hosts" in reports:
+            print(f"slowest locations over the last {days} day(s):")
+            for location, runs, avg, worst in h.slowest_hosts(since=since, limit=limit):
+                print(
+                    f"  {location}  {runs} run(s), {avg:.2f}s average, {worst:.2f}s worst"
+                )
+        if "steps" in reports:
+            print(f"slowest steps over the last {days} day(s):")
+            for command, resource, runs, avg, worst in h.slowest_steps(
+                since=since, limit=limit
+            ):
+                print(
+                    f"  {command} '{resource}'  {runs} run(s), {avg:.3f}s average, {worst:.3f}s worst"
+                )
+        if "errors" in reports:
+            print(f"errors per day over the last {days} day(s):")
+            for day, runs, failed, errors, avg in h.error_trend(since=since):
+                print(
+                    f"  {day}  {runs} run(s), {failed} failed, {errors} error(s), {avg:.2f}s average"
+                )
+    finally:
+        h.close()
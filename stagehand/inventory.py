@@ -0,0 +1,54 @@
+import yaml
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+
+class Inventory:
+    """Template variables for each location.
+
+    Variables under "vars" apply to every location, and those under a
+    location in "locations" override them for that location, e.g.
+
+        vars:
+          domain: example.com
+        locations:
+          root@10.2.3.4:
+            hostname: web1
+    """
+
+    def __init__(self, *, vars={}, locations={}):
+        self.vars = _strings(vars)
+        self.locations = {
+            location: _strings(v or {}) for location, v in (locations or {}).items()
+        }
+
+    def variables(self, location):
+        """Return {name: value} of the template variables for a location."""
+        variables = {"location": location}
+        variables.update(self.vars)
+        variables.update(self.locations.get(location, {}))
+        return variables
+
+
+def _strings(d):
+    # YAML gives numbers and booleans for unquoted values, templates want
+    # strings; booleans as YAML writes them
+    return {
+        str(k): (str(v).lower() if isinstance(v, bool) else str(v))
+        for k, v in (d or {}).items()
+    }
+
+
+def load(filename):
+    with open(filename, "rb") as f:
+        d = yaml.load(f, Loader=_SafeLoader)
+    if d is None:
+        d = {}
+    if not isinstance(d, dict) or set(d) - {"vars", "locations"}:
+        raise ValueError(
+            f"can't parse inventory '{filename}'; it should have 'vars' and/or 'locations'"
+        )
+    return Inventory(**d)
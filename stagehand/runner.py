@@ -1,150 +1,713 @@
 import argparse
-import getpass
+import concurrent.futures
 import hashlib
 import io
 import inspect
 import json
+import multiprocessing
+import queue
 import random
 import string
 import sys
 import time
-import urllib.parse
 
 from . import commands
+from . import credentials
 from . import debug
+from . import delta
+from . import history
+from . import inventory
 from . import scenario
 from . import session
+from . import tracing
+from . import transport
+
+# managed files at least this big are patched instead of re-uploaded
+_DELTA_MIN_SIZE = 64 * 1024
+
+# changed files in a directory are sent in archives of about this size,
+# see _execute_directory_sync
+_DIRECTORY_BATCH_SIZE = 64 * 1024 * 1024
+# a file alone in an archive has to fit in a frame, with room for its tar
+# header and padding
+_DIRECTORY_FILE_MAX_SIZE = commands.FRAME_MAX_LENGTH - 64 * 1024
+
+_APPLY_VERBS = {
+    ("package", "install"): "installing",
+    ("package", "remove"): "removing",
+    ("file", "copy"): "copying",
+    ("file", "delete"): "deleting",
+    ("service", "restart"): "restarting",
+}
 
 
 class Runner:
-    def __init__(self, *, scenario_file, locations, rehearsal, _debug):
+    def __init__(
+        self,
+        *,
+        scenario_file,
+        locations,
+        rehearsal,
+        _debug,
+        inventory_file=None,
+        parallel=1,
+        processes=1,
+        agent_apply=False,
+        bootstrap="sftp",
+        apt_update_max_age=None,
+        compression="none",
+        hash_cache=None,
+        agent_workers=1,
+        dpkg_admindir=None,
+        scenario_cache_dir=None,
+        auth="password",
+        identity_file=None,
+        credential_store=None,
+        history_db=None,
+        state_manifest=None,
+        trace=None,
+        trace_format="jsonl",
+    ):
         self.scenario_file = scenario_file
         self.locations = locations
         self.rehearsal = rehearsal
         self.debug = _debug
+        self.inventory_file = inventory_file
+        self.parallel = parallel
+        self.processes = processes
+        self.agent_apply = agent_apply
+        self.bootstrap = bootstrap
+        self.apt_update_max_age = apt_update_max_age
+        self.compression = compression
+        self.hash_cache = hash_cache
+        self.agent_workers = agent_workers
+        self.dpkg_admindir = dpkg_admindir
+        self.scenario_cache_dir = scenario_cache_dir
+        self.auth = auth
+        self.identity_file = identity_file
+        self.credential_store = credential_store
+        self.history_db = history_db
+        self.state_manifest = state_manifest
+        self.trace = trace
+        self.trace_format = trace_format
+        self._inventory = inventory.Inventory()
+        self._history = None
+        self._tracer = None
+
+    def __getstate__(self):
+        # for worker processes, which record neither history nor into the
+        # parent's tracer
+        d = dict(self.__dict__)
+        d["_history"] = None
+        d["_tracer"] = None
+        return d
 
     def run(self):
         debug.set_debug(self.debug)
-        scn = scenario.load(self.scenario_file)
+        scn = scenario.load(self.scenario_file, cache_dir=self.scenario_cache_dir)
+        if self.inventory_file is not None:
+            self._inventory = inventory.load(self.inventory_file)
+        locations = self.locations.split(",")
+        # every credential is gathered up front, so nothing prompts once
+        # locations start executing
+        store = None
+        if self.credential_store is not None:
+            store = credentials.open_store(self.credential_store)
+        creds = credentials.resolve(
+            locations, auth=self.auth, store=store, key_filename=self.identity_file
+        )
+        if self.history_db is not None:
+            self._history = history.History(self.history_db)
+        if self.trace is not None:
+            self._tracer = tracing.Tracer()
+        start = time.perf_counter()
         print("*" * 80)
-        for loc in self.locations.split(","):
-            print(f"executing scenario '{self.scenario_file}' against location '{loc}'")
+        try:
+            if self.processes > 1 and len(locations) > 1:
+                results = self._run_processes(scn, locations, creds)
+            elif self.parallel > 1:
+                results = self._run_parallel(scn, locations, creds)
+            else:
+                results = []
+                for loc in locations:
+                    result = self._run_location(scn, loc, creds[loc])
+                    self._record(scn, result)
+                    results.append(result)
+        finally:
+            if self._history is not None:
+                self._history.close()
+                self._history = None
+        elapsed_seconds = round((time.perf_counter() - start), 2)
+        if store is not None:
+            auth_failed = {r.location for r in results if r.auth_failed}
+            credentials.update_store(store, creds, auth_failed)
+        if len(results) > 1:
+            self._print_summary(results, elapsed_seconds)
+        if self._tracer is not None:
+            self._tracer.write(self.trace, self.trace_format)
+            print(
+                f"trace of {len(self._tracer.spans)} span(s) written to '{self.trace}'"
+            )
+        return results
+
+    def _run_parallel(self, scn, locations, creds):
+        results = []
+
+        def completed(result):
+            print(result.output.getvalue(), end="", flush=True)
+            self._record(scn, result)
+            results.append(result)
+
+        self._run_threads(scn, locations, creds, completed)
+        order = {loc: i for i, loc in enumerate(locations)}
+        results.sort(key=lambda r: order[r.location])
+        return results
+
+    def _run_threads(self, scn, locations, creds, completed):
+        # output is buffered per location and printed as one block when the
+        # location completes, so concurrent locations don't interleave.
+        # completed is called with each result, from the calling thread
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            futures = [
+                pool.submit(self._run_location, scn, loc, creds[loc], io.StringIO())
+                for loc in locations
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                completed(future.result())
+
+    def _run_processes(self, scn, locations, creds):
+        # SSH crypto is CPU bound and paramiko's is mostly pure Python, so
+        # one interpreter tops out at a core. Locations are sharded across
+        # worker processes, each running up to self.parallel of them at
+        # once, and results stream back as they complete
+        results = []
+        q = multiprocessing.Queue()
+        workers = []
+        for i in range(min(self.processes, len(locations))):
+            shard = locations[i :: self.processes]
+            p = multiprocessing.Process(
+                target=_run_shard,
+                args=(self, i, scn, shard, {loc: creds[loc] for loc in shard}, q),
+                daemon=True,
+            )
+            p.start()
+            workers.append((p, shard))
+        done = set()
+        seen = set()
+        while len(done) < len(workers):
             try:
-                executor = Executor(
-                    scenario=scn, location=loc, rehearsal=self.rehearsal
-                )
-                executor.run()
+                kind, payload = q.get(timeout=1)
+            except queue.Empty:
+                # a worker that died without saying it was done, e.g. was
+                # killed, takes its outstanding locations down with it
+                for i, (p, shard) in enumerate(workers):
+                    if i in done or p.exitcode in [None, 0]:
+                        continue
+                    done.add(i)
+                    for loc in shard:
+                        if loc in seen:
+                            continue
+                        result = LocationResult(location=loc, output=io.StringIO())
+                        result.failure = f"worker process exited with code {p.exitcode}"
+                        result.started_at = result.finished_at = time.time()
+                        print(f"location '{loc}' failed: {result.failure}")
+                        self._record(scn, result)
+                        results.append(result)
+                continue
+            if kind == "result":
+                payload.output = io.StringIO(payload.output)
+                print(payload.output.getvalue(), end="", flush=True)
+                self._record(scn, payload)
+                seen.add(payload.location)
+                results.append(payload)
+            else:
+                worker, spans = payload
+                done.add(worker)
+                if self._tracer is not None:
+                    self._tracer.spans.extend(spans)
+        for p, _ in workers:
+            p.join()
+        order = {loc: i for i, loc in enumerate(locations)}
+        results.sort(key=lambda r: order[r.location])
+        return results
+
+    def _record(self, scn, result):
+        # called from the main thread as each location completes, so the
+        # database is only ever written from one thread, a location at a time
+        if self._history is not None:
+            self._history.record(
+                scenario_file=self.scenario_file,
+                scenario_hash=scn.hash,
+                rehearsal=self.rehearsal,
+                result=result,
+            )
+
+    def _run_location(self, scn, loc, credential, output=None):
+        if output is None:
+            output = sys.stdout
+        result = LocationResult(location=loc, output=output)
+        print(
+            f"executing scenario '{self.scenario_file}' against location '{loc}'",
+            file=output,
+            flush=True,
+        )
+        start = time.perf_counter()
+        result.started_at = time.time()
+        executor = None
+        try:
+            executor = Executor(
+                scenario=scn,
+                location=loc,
+                variables=self._inventory.variables(loc),
+                credential=credential,
+                rehearsal=self.rehearsal,
+                output=output,
+                agent_apply=self.agent_apply,
+                bootstrap=self.bootstrap,
+                apt_update_max_age=self.apt_update_max_age,
+                compression=self.compression,
+                hash_cache=self.hash_cache,
+                agent_workers=self.agent_workers,
+                dpkg_admindir=self.dpkg_admindir,
+                state_manifest=self.state_manifest,
+                tracer=self._tracer.child(loc) if self._tracer is not None else None,
+            )
+            executor.run()
+            result.errors = executor.errors
+            if executor.content_bytes:
                 print(
-                    f"scenario execution completed with {executor.errors} error(s) in {executor.elapsed_seconds} seconds"
+                    f"sent {executor.content_bytes} bytes of file content ({executor.content_wire_bytes} bytes on the wire)",
+                    file=output,
                 )
-            except Exception as e:
-                print("execution failed: {e}")
-            print("*" * 80)
+            print(
+                f"scenario execution completed with {executor.errors} error(s) in {executor.elapsed_seconds} seconds",
+                file=output,
+            )
+        except session.SessionAuthError as e:
+            result.auth_failed = True
+            result.failure = str(e)
+            print(f"execution failed: {e}", file=output)
+        except Exception as e:
+            result.failure = str(e)
+            print(f"execution failed: {e}", file=output)
+        result.elapsed_seconds = round((time.perf_counter() - start), 2)
+        result.finished_at = time.time()
+        if executor is not None:
+            result.steps = executor.steps
+        print("*" * 80, file=output, flush=True)
+        return result
+
+    def _print_summary(self, results, elapsed_seconds):
+        print(f"summary for {len(results)} location(s):")
+        width = max(len(r.location) for r in results)
+        for r in results:
+            if r.failure is not None:
+                status = f"failed: {r.failure}"
+            else:
+                status = f"{r.errors} error(s)"
+            print(f"  {r.location:<{width}}  {r.elapsed_seconds:>8.2f}s  {status}")
+        failed = sum(1 for r in results if r.failure is not None)
+        errors = sum(r.errors for r in results)
+        print(
+            f"{failed} location(s) failed, {errors} error(s) in total, completed in {elapsed_seconds} seconds"
+        )
+        print("*" * 80)
+
+
+class LocationResult:
+    def __init__(self, *, location, output):
+        self.location = location
+        self.output = output
+        self.errors = 0
+        self.failure = None
+        self.auth_failed = False
+        self.elapsed_seconds = 0.0
+        # wall clock times, for the history
+        self.started_at = None
+        self.finished_at = None
+        self.steps = []
+
+
+def _batches(paths, sizes, batch_size):
+    # paths split into lists whose tar archives are about batch_size bytes,
+    # a file bigger than that on its own
+    batches = []
+    batch = []
+    total = 0
+    for path in paths:
+        # a 512 byte header, content padded to 512 byte blocks, and GNU
+        # format's extra header and blocks for names of 100 bytes or more
+        size = 512 + _blocks(sizes[path])
+        name_size = len(path.encode())
+        if name_size >= 100:
+            size += 512 + _blocks(name_size + 1)
+        if batch and total + size > batch_size:
+            batches.append(batch)
+            batch = []
+            total = 0
+        batch.append(path)
+        total += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _blocks(size):
+    # size rounded up to tar's 512 byte blocks
+    return -(-size // 512) * 512
+
+
+def _run_shard(runner, worker, scn, locations, creds, q):
+    # the body of a worker process, see Runner._run_processes. Results are
+    # sent back with their output as a string, the spans traced at the end
+    if runner.trace is not None:
+        runner._tracer = tracing.Tracer()
+    debug.set_debug(runner.debug)
+
+    def completed(result):
+        result.output = result.output.getvalue()
+        q.put(("result", result))
+
+    try:
+        runner._run_threads(scn, locations, creds, completed)
+    finally:
+        spans = runner._tracer.spans if runner._tracer is not None else []
+        q.put(("done", (worker, spans)))
 
 
 class Executor:
-    def __init__(self, *, scenario, location, rehearsal):
-        self.scenario = scenario
+    def __init__(
+        self,
+        *,
+        scenario,
+        location,
+        rehearsal,
+        variables={},
+        credential=None,
+        output=None,
+        agent_apply=False,
+        bootstrap="sftp",
+        apt_update_max_age=None,
+        compression="none",
+        hash_cache=None,
+        agent_workers=1,
+        dpkg_admindir=None,
+        state_manifest=None,
+        tracer=None,
+    ):
+        # templated files are rendered for the location up front
+        self.scenario = scenario.render(variables)
         self.location = location
         self.rehearsal = rehearsal
-
-        url = urllib.parse.urlparse(f"ssh://{self.location}")
-        hostname = url.hostname
-        port = url.port
-        if port is None:
-            port = 22
-        username = url.username
-        if hostname is None or username is None:
-            raise ValueError(
-                f"can't parse location '{self.location}'; make sure it's in the format 'username@hostname[:port]', e.g. 'root@10.20.30.40'"
-            )
-        self.hostname = hostname
-        self.port = port
-        self.username = username
+        if credential is None:
+            credential = credentials.Credential()
+        self.credential = credential
+        self.output = output if output is not None else sys.stdout
+        self.agent_apply = agent_apply
+        self.bootstrap = bootstrap
+        self.agent_options = {
+            "apt_update_max_age": apt_update_max_age,
+            "hash_cache": hash_cache,
+            "workers": agent_workers,
+            "dpkg_admindir": dpkg_admindir,
+        }
+        self.compression = compression
+        self.state_manifest = state_manifest
+        # resources the state manifest says are unchanged since the last
+        # clean run, they're skipped
+        self.unchanged = set()
+        self.tracer = tracer if tracer is not None else tracing.Tracer(enabled=False)
+
+        self.transport = transport.from_location(
+            self.location,
+            password=self.credential.password,
+            key_filename=self.credential.key_filename,
+            tracer=self.tracer,
+        )
 
         self.restarts = []
         self.errors = 0
+        # history.Step for each resource, in the order they completed
+        self.steps = []
+        self._step = None
+        # file content sent, before and after compression/delta encoding
+        self.content_bytes = 0
+        self.content_wire_bytes = 0
 
     def run(self):
         self.session = self._start_session()
+        try:
+            self._run()
+        finally:
+            # a no-op once stopped, otherwise the location failed part way
+            # and its connection and the session's writer are closed
+            self.session.close()
+
+    def _run(self):
         start = time.perf_counter()
 
         # 0. rehearsal start
         if self.rehearsal:
             self._execute_rehearsal_start()
 
-        # 1. package installs
-        for pkg in self.scenario.packages:
-            if pkg.action == "install":
-                self._execute_package_install(pkg)
-
-        # 2. package removes
-        for pkg in self.scenario.packages:
-            if pkg.action == "remove":
-                self._execute_package_remove(pkg)
+        if self.state_manifest is not None:
+            self._execute_check_manifest()
 
-        # 3. file copies
-        for f in self.scenario.files:
-            if f.action == "copy":
-                self._execute_file_copy(f)
+        if self.agent_apply:
+            self._execute_apply_scenario()
+        else:
+            self._execute_phases()
 
-        # 4. file deletes
-        for f in self.scenario.files:
-            if f.action == "delete":
-                self._execute_file_delete(f)
+        if self.state_manifest is not None and self.errors == 0 and not self.rehearsal:
+            self._execute_write_manifest()
 
-        # 5. restarts
-        for svc in self.restarts:
-            self._execute_service_restart(svc)
+        # surfaces a rejected Configure, its response has long since arrived
+        self.session.configuration()
+        if self.agent_options["hash_cache"] is not None:
+            self._print_hash_cache_stats()
 
         self.elapsed_seconds = round((time.perf_counter() - start), 2)
         self.session.stop()
+        self.tracer.add("execute", start, time.perf_counter() - start)
+
+    def _execute_phases(self):
+        # commands within a phase are pipelined: they're all submitted up
+        # front and the responses are handled in order as they arrive
+
+        # 1. package installs
+        # 2. package removes
+        # each is a single apt transaction on the agent, for just the
+        # packages that need changing; they're found from dpkg's status
+        # first, so the agent only opens the apt cache if there are any
+        packages = self._changed(self.scenario.packages)
+        submitted = time.perf_counter()
+        installed = self._query_packages(packages)
+        installs = [pkg for pkg in packages if pkg.action == "install"]
+        removes = [pkg for pkg in packages if pkg.action == "remove"]
+        install_names = [p.name for p in installs if installed.get(p.name) is not True]
+        remove_names = [p.name for p in removes if installed.get(p.name) is not False]
+        if install_names:
+            cmd = commands.PackageInstallBatch(packages=install_names)
+            install_future = self.session.submit(cmd)
+        if remove_names:
+            cmd = commands.PackageRemoveBatch(packages=remove_names)
+            remove_future = self.session.submit(cmd)
+        results = {}
+        if install_names:
+            results["install"] = dict(
+                zip(install_names, install_future.result().results)
+            )
+        if remove_names:
+            results["remove"] = dict(zip(remove_names, remove_future.result().results))
+        for pkg in installs:
+            cmd_resp = self._package_response(results, "install", pkg)
+            self._execute_package_install(pkg, cmd_resp, submitted)
+        for pkg in removes:
+            cmd_resp = self._package_response(results, "remove", pkg)
+            self._execute_package_remove(pkg, cmd_resp, submitted)
+
+        # 3. file copies
+        files = self._changed(self.scenario.files)
+        copies = [f for f in files if f.action == "copy"]
+        if copies:
+            # diff every file in a single exchange before uploading anything
+            cmd = commands.FileGetPropsBatch(paths=[f.path for f in copies])
+            cmd_resp = self.session.execute_command(cmd)
+            props = [commands.fromdict(p) for p in cmd_resp.results]
+            # content going through the agent is all sent before waiting on
+            # any of it, so the agent can write files concurrently
+            writes = {}
+            if not self.rehearsal:
+                for f, p in zip(copies, props):
+                    if p.result != "error" and self._agent_write(f, p):
+                        writes[f.path] = self._submit_write(f)
+            for f, p in zip(copies, props):
+                self._execute_file_copy(f, p, writes.get(f.path))
+
+        # 4. directories
+        if self.scenario.directories:
+            self._execute_directories()
+
+        # 5. file deletes
+        submitted = time.perf_counter()
+        deletes = [
+            (f, self.session.submit(commands.FileDelete(path=f.path)))
+            for f in files
+            if f.action == "delete"
+        ]
+        for f, future in deletes:
+            self._execute_file_delete(f, future, submitted)
+
+        # 6. restarts
+        self._execute_restarts()
+
+    def _execute_restarts(self):
+        # all queued at once on the agent, which waits for them concurrently
+        if self.restarts:
+            cmd = commands.ServiceRestartBatch(services=self.restarts)
+            results = self.session.execute_command(cmd).results
+            for svc, cmd_resp in zip(self.restarts, results):
+                self._execute_service_restart(svc, commands.fromdict(cmd_resp))
 
     def _start_session(self):
-        while True:
-            try:
-                password = ""
-                while password == "":
-                    password = getpass.getpass(f"password for '{self.location}': ")
-                sess = session.Session(
-                    hostname=self.hostname,
-                    port=self.port,
-                    username=self.username,
-                    password=password,
+        sess = session.Session(
+            transport=self.transport,
+            bootstrap=self.bootstrap,
+            agent_options=self.agent_options,
+            compression=self.compression,
+            tracer=self.tracer,
+        )
+        try:
+            sess.start()
+        except session.SessionAuthError:
+            sess.close()
+            raise session.SessionAuthError(
+                f"authentication failed for location '{self.location}'"
+            )
+        except BaseException:
+            sess.close()
+            raise
+        return sess
+
+    def _execute_apply_scenario(self):
+        # the agent converges the whole scenario itself and reports back on
+        # each resource as it goes
+        scn = {
+            "files": [self._apply_file(f) for f in self._changed(self.scenario.files)],
+            "packages": [p.todict() for p in self._changed(self.scenario.packages)],
+        }
+        # services directories restart are restarted once, after they're
+        # synced, rather than by the agent before that too
+        deferred = []
+        for d in self.scenario.directories:
+            deferred.extend(r for r in d.restarts if r not in deferred)
+        cmd = commands.ApplyScenario(
+            scenario=scn, rehearsal=self.rehearsal, deferred_restarts=deferred
+        )
+        # the agent works through resources one after the other, each step
+        # starts when the previous one completed
+        started = time.perf_counter()
+        for cmd_resp in self.session.submit_stream(cmd):
+            if cmd_resp.result == "deferred":
+                self._add_restarts([cmd_resp.resource])
+            elif cmd_resp.name == "apply-scenario-result":
+                self._begin_step(
+                    f"{cmd_resp.kind}-{cmd_resp.action}", cmd_resp.resource, started
                 )
-                sess.start()
-                return sess
-            except session.SessionAuthError:
-                print("incorrect password!")
+                started = time.perf_counter()
+                verb = _APPLY_VERBS[(cmd_resp.kind, cmd_resp.action)]
+                self._print(f"{verb} {cmd_resp.kind} '{cmd_resp.resource}'... ", end="")
+                self._process_cmd_resp(cmd_resp)
+            elif cmd_resp.result == "error":
+                self._print(f"error: {cmd_resp.error}")
+                self.errors += 1
+
+        # directories are diffed and synced from here, once the agent's done,
+        # and the services they (or deferred resources) restart are restarted
+        # after them
+        if self.scenario.directories:
+            self._execute_directories()
+            self._execute_restarts()
+
+    def _apply_file(self, f):
+        # content is sent compressed, like any other through the agent
+        d = f.todict()
+        d["compression"] = "none"
+        if d["content"] is not None:
+            data = d["content"]
+            d["compression"], d["content"] = self.session.encode(data)
+            self.content_bytes += len(data)
+            self.content_wire_bytes += len(d["content"])
+        return d
+
+    def _execute_check_manifest(self):
+        resources = self.scenario.fingerprints()
+        cmd = commands.CheckManifest(path=self.state_manifest, resources=resources)
+        cmd_resp = self.session.execute_command(cmd)
+        if cmd_resp.result == "error":
+            # not fatal, everything just gets checked
+            self._print(f"state manifest: error: {cmd_resp.error}")
+            return
+        self.unchanged = set(cmd_resp.unchanged)
+        self._print(
+            f"state manifest: {len(self.unchanged)} of {len(resources)} resource(s) unchanged since the last clean run"
+        )
+
+    def _execute_write_manifest(self):
+        cmd = commands.WriteManifest(
+            path=self.state_manifest,
+            resources=self.scenario.fingerprints(),
+        )
+        cmd_resp = self.session.execute_command(cmd)
+        if cmd_resp.result == "error":
+            self._print(f"state manifest: error: {cmd_resp.error}")
+            self.errors += 1
+
+    def _changed(self, resources):
+        return [r for r in resources if r.resource() not in self.unchanged]
+
+    def _print_hash_cache_stats(self):
+        cmd_resp = self.session.execute_command(commands.AgentStats())
+        hits = cmd_resp.stats["hash_cache_hits"]
+        misses = cmd_resp.stats["hash_cache_misses"]
+        self._print(f"hash cache: {hits} hit(s), {misses} miss(es)")
 
     def _execute_rehearsal_start(self):
-        print(f"starting REHEARSAL (nothing will be changed)... ", end="", flush=True)
+        self._print(
+            f"starting REHEARSAL (nothing will be changed)... ", end="", flush=True
+        )
+        self._begin_step("rehearsal-start", "")
         cmd = commands.RehearsalStart()
         cmd_resp = self.session.execute_command(cmd)
         self._process_cmd_resp(cmd_resp)
 
-    def _execute_package_install(self, pkg):
-        print(f"installing package '{pkg.name}'... ", end="", flush=True)
-        cmd = commands.PackageInstall(package=pkg.name)
+    def _query_packages(self, packages):
+        # {package: installed}, empty if dpkg's status can't be read on the
+        # location, in which case apt is left to decide
+        if not packages:
+            return {}
+        cmd = commands.PackageQueryBatch(packages=[pkg.name for pkg in packages])
         cmd_resp = self.session.execute_command(cmd)
+        if cmd_resp.result == "error":
+            debug.print(f"can't query packages: {cmd_resp.error}")
+            return {}
+        return {r["package"]: r["installed"] for r in cmd_resp.results}
+
+    def _package_response(self, results, action, pkg):
+        cmd_resp = results.get(action, {}).get(pkg.name)
+        if cmd_resp is not None:
+            return commands.fromdict(cmd_resp)
+        # already in the desired state, it wasn't sent to apt
+        if action == "install":
+            resp_cls = commands.PackageInstallResponse
+        else:
+            resp_cls = commands.PackageRemoveResponse
+        return resp_cls(package=pkg.name, result="noop", error="")
+
+    def _execute_package_install(self, pkg, cmd_resp, submitted):
+        self._begin_step("package-install", pkg.name, submitted)
+        self._print(f"installing package '{pkg.name}'... ", end="", flush=True)
         self._process_cmd_resp(cmd_resp, pkg.restarts)
 
-    def _execute_package_remove(self, pkg):
-        print(f"removing package '{pkg.name}'...", end="", flush=True)
-        cmd = commands.PackageRemove(package=pkg.name)
-        cmd_resp = self.session.execute_command(cmd)
+    def _execute_package_remove(self, pkg, cmd_resp, submitted):
+        self._begin_step("package-remove", pkg.name, submitted)
+        self._print(f"removing package '{pkg.name}'...", end="", flush=True)
         self._process_cmd_resp(cmd_resp, pkg.restarts)
 
-    def _execute_file_delete(self, f):
-        print(f"deleting file '{f.path}'... ", end="", flush=True)
-        cmd = commands.FileDelete(path=f.path)
-        cmd_resp = self.session.execute_command(cmd)
+    def _execute_file_delete(self, f, future, submitted):
+        self._begin_step("file-delete", f.path, submitted)
+        self._print(f"deleting file '{f.path}'... ", end="", flush=True)
+        cmd_resp = future.result()
         self._process_cmd_resp(cmd_resp, f.restarts)
 
-    def _execute_file_copy(self, f):
-        print(f"copying file '{f.path}'... ", end="", flush=True)
-        cmd = commands.FileGetProps(path=f.path)
-        cmd_resp = self.session.execute_command(cmd)
+    def _execute_file_copy(self, f, cmd_resp, write=None):
+        self._begin_step("file-copy", f.path)
+        self._print(f"copying file '{f.path}'... ", end="", flush=True)
+        if cmd_resp.result == "error":
+            self._print(f"error: {cmd_resp.error}")
+            self.errors += 1
+            self._end_step("error", cmd_resp.error)
+            return
 
         if (
             f.hash == cmd_resp.hash
@@ -153,22 +716,22 @@ class Executor:
             and f.mode == cmd_resp.mode
         ):
             # noop
-            print("nothing to do")
+            self._print("nothing to do")
+            self._end_step("noop")
             return
 
         # check if same file
         if f.hash != cmd_resp.hash:
             # no, copy to remote
             if not self.rehearsal:
-                self.session.put_data(f.content.encode(), f.path)
+                cmd_resp = self._put_content(f, cmd_resp, write)
 
                 # check again
-                cmd = commands.FileGetProps(path=f.path)
-                cmd_resp = self.session.execute_command(cmd)
                 if f.hash != cmd_resp.hash:
                     # failed
-                    print("error: couldn't copy file")
+                    self._print("error: couldn't copy file")
                     self.errors += 1
+                    self._end_step("error", "couldn't copy file")
                     return
 
         # check user + group + mode
@@ -187,8 +750,9 @@ class Executor:
                 )
                 cmd_resp = self.session.execute_command(cmd)
                 if cmd_resp.result == "error":
-                    print(f"error: {cmd_resp.error}")
+                    self._print(f"error: {cmd_resp.error}")
                     self.errors += 1
+                    self._end_step("error", cmd_resp.error)
                     return
 
                 # check again
@@ -200,34 +764,211 @@ class Executor:
                     or f.mode != cmd_resp.mode
                 ):
                     # failed
-                    print("error: couldn't modify file props")
+                    self._print("error: couldn't modify file props")
                     self.errors += 1
+                    self._end_step("error", "couldn't modify file props")
                     return
 
-        print("done")
+        self._print("done")
+        self._end_step("ok")
         return self._add_restarts(f.restarts)
 
-    def _execute_service_restart(self, service):
-        print(f"restarting service '{service}'... ", end="", flush=True)
-        cmd = commands.ServiceRestart(service=service)
+    def _put_content(self, f, props, write=None):
+        # returns the props of the file once it's been put
+        if write is not None:
+            # already sent, see _execute_phases
+            return write.result()
+
+        data = f.content.encode()
+        # big files that are already on the location are patched rather
+        # than uploaded again
+        if props.hash != "" and len(data) >= _DELTA_MIN_SIZE:
+            literal_bytes = self._put_delta(f, data)
+            if literal_bytes is not None:
+                self.content_bytes += len(data)
+                self.content_wire_bytes += literal_bytes
+                return self.session.execute_command(commands.FileGetProps(path=f.path))
+
+        if self._through_agent():
+            return self._submit_write(f).result()
+
+        self.content_bytes += len(data)
+        self.session.put_data(data, f.path)
+        self.content_wire_bytes += len(data)
+        return self.session.execute_command(commands.FileGetProps(path=f.path))
+
+    def _through_agent(self):
+        # without SFTP, content always goes through the agent
+        return self.compression != "none" or not self.transport.sftp
+
+    def _agent_write(self, f, props):
+        # whether the file's content is to be written through the agent in
+        # full, rather than patched or put with SFTP
+        if f.hash == props.hash or not self._through_agent():
+            return False
+        return props.hash == "" or len(f.content.encode()) < _DELTA_MIN_SIZE
+
+    def _submit_write(self, f):
+        data = f.content.encode()
+        future, wire_bytes = self.session.submit_write_data(
+            data, f.path, user=f.user, group=f.group, mode=f.mode
+        )
+        self.content_bytes += len(data)
+        self.content_wire_bytes += wire_bytes
+        return future
+
+    def _put_delta(self, f, data):
+        # returns the number of literal bytes sent, or None if the file
+        # wasn't patched
+        cmd = commands.FileGetSignature(
+            path=f.path, block_size=delta.block_size(len(data))
+        )
         cmd_resp = self.session.execute_command(cmd)
-        self._process_cmd_resp(cmd_resp)
+        if cmd_resp.result == "error":
+            return None
+
+        # not worth it if most of the file has to be sent anyway
+        d = delta.compute(
+            data, cmd_resp.block_size, cmd_resp.signatures, limit=len(data) // 2
+        )
+        if d is None:
+            return None
+        ops, literal_bytes = d
+        debug.print(f"patching '{f.path}' with {literal_bytes} of {len(data)} bytes")
+        cmd = commands.FilePatch(
+            path=f.path, block_size=cmd_resp.block_size, delta=ops, hash=f.hash
+        )
+        cmd_resp = self.session.execute_command(cmd)
+        return literal_bytes if cmd_resp.result == "ok" else None
+
+    def _execute_directories(self):
+        # each directory is diffed in one exchange, then only the files that
+        # changed are sent, in one archive. Manifests and diffs of large
+        # trees are large, so a directory's diff is waited for before the
+        # next is sent, rather than pipelined
+        for d in self.scenario.directories:
+            submitted = time.perf_counter()
+            cmd = commands.DirectoryDiff(
+                path=d.path,
+                entries=d.entries(),
+                user=d.user,
+                group=d.group,
+                mode=d.mode,
+                purge=d.purge,
+            )
+            diff = self.session.execute_command(cmd)
+            self._execute_directory_sync(d, diff, submitted)
+
+    def _execute_directory_sync(self, d, diff, submitted):
+        self._begin_step("directory-sync", d.path, submitted)
+        self._print(f"syncing directory '{d.path}'... ", end="", flush=True)
+        if diff.result == "error":
+            self._print(f"error: {diff.error}")
+            self.errors += 1
+            self._end_step("error", diff.error)
+            return
+
+        delete = diff.unmanaged if d.purge else []
+        if not (diff.changed or diff.props or delete):
+            self._print("nothing to do")
+            self._end_step("noop")
+            return
+
+        summary = f"{len(diff.changed)} file(s) copied, {len(diff.props)} with props set, {len(delete)} purged"
+        if self.rehearsal:
+            self._print(f"done (rehearsal): {summary}")
+            self._end_step("ok")
+            return self._add_restarts(d.restarts)
+
+        sizes = {rel: size for rel, size, _ in d.entries()}
+        too_big = [rel for rel in diff.changed if sizes[rel] > _DIRECTORY_FILE_MAX_SIZE]
+        if too_big:
+            error = f"file too big to sync: '{too_big[0]}' ({sizes[too_big[0]]} bytes)"
+            self._print(f"error: {error}")
+            self.errors += 1
+            self._end_step("error", error)
+            return
+
+        # one sync per archive of about _DIRECTORY_BATCH_SIZE, so only one is
+        # held in memory at a time; props are set and files purged with the
+        # last. There's nothing to archive if that's all there is to do
+        batches = _batches(diff.changed, sizes, _DIRECTORY_BATCH_SIZE) or [[]]
+        for i, batch in enumerate(batches):
+            last = i == len(batches) - 1
+            archive = d.archive(batch) if batch else b""
+            cmd_resp, wire_bytes = self.session.sync_directory(
+                archive,
+                d.path,
+                user=d.user,
+                group=d.group,
+                mode=d.mode,
+                props=diff.props if last else [],
+                delete=delete if last else [],
+            )
+            if archive:
+                self.content_bytes += len(archive)
+                self.content_wire_bytes += wire_bytes
+            if cmd_resp.result == "error":
+                break
+        if cmd_resp.result == "error":
+            self._print(f"error: {cmd_resp.error}")
+            self.errors += 1
+            self._end_step("error", cmd_resp.error)
+            return
+        self._print(f"done: {summary}")
+        self._end_step("ok")
+        return self._add_restarts(d.restarts)
+
+    def _execute_service_restart(self, service, cmd_resp):
+        # the restarts ran concurrently, the agent timed each of them
+        self._begin_step(
+            "service-restart", service, time.perf_counter() - cmd_resp.duration
+        )
+        self._print(f"restarting service '{service}'... ", end="", flush=True)
+        if cmd_resp.result == "ok" and not self.rehearsal:
+            self._print(f"done in {cmd_resp.duration} seconds")
+            self._end_step("ok")
+        else:
+            self._process_cmd_resp(cmd_resp)
 
     def _process_cmd_resp(self, cmd_resp, restarts=[]):
         if cmd_resp.result == "ok":
             if self.rehearsal:
-                print("done (rehearsal)")
+                self._print("done (rehearsal)")
             else:
-                print("done")
+                self._print("done")
             self._add_restarts(restarts)
         elif cmd_resp.result == "noop":
-            print("nothing to do")
+            self._print("nothing to do")
         elif cmd_resp.result == "error":
-            print(f"error: {cmd_resp.error}")
+            self._print(f"error: {cmd_resp.error}")
             self.errors += 1
+        self._end_step(cmd_resp.result, cmd_resp.error)
+
+    def _begin_step(self, command, resource, started=None):
+        # pipelined and batched steps started when their command was
+        # submitted, not when their response is processed
+        if started is None:
+            started = time.perf_counter()
+        self._step = (command, resource, started)
+
+    def _end_step(self, result, error=""):
+        command, resource, started = self._step
+        self.steps.append(
+            history.Step(
+                command=command,
+                resource=resource,
+                result=result,
+                error=error,
+                duration=round(time.perf_counter() - started, 3),
+            )
+        )
 
     def _add_restarts(self, restarts):
         for r in restarts:
             if r not in self.restarts:
                 self.restarts.append(r)
 
+    def _print(self, *args, **kwargs):
+        print(*args, file=self.output, **kwargs)
+
@@ -1,9 +1,48 @@
+import copy
+import functools
 import hashlib
+import io
+import os
+import os.path
+import pickle
+import string
+import sys
+import tarfile
+import tempfile
+import threading
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+
+# bump whenever File, Directory, Package or Scenario change shape, so stale
+# compiled scenarios aren't loaded
+_CACHE_VERSION = 3
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+# rendered templates kept, see _render
+_RENDER_CACHE_SIZE = 1024
+
 
 class File:
+    __slots__ = (
+        "path",
+        "action",
+        "group",
+        "user",
+        "mode",
+        "content",
+        "restarts",
+        "hash",
+        "template",
+        "variables",
+    )
+
     def __init__(
         self,
         *,
@@ -13,23 +52,158 @@ class File:
         user=None,
         mode=None,
         content=None,
+        template=False,
         restarts=[],
     ):
         self.path = path
-        self.action = action
         if action not in ["copy", "delete"]:
             raise ValueError("file.action must be either 'copy' or 'delete'")
-        self.group = group
-        self.user = user
-        self.mode = mode if isinstance(mode, str) else str(mode)
+        self.action = sys.intern(action)
+        self.group = _intern(group)
+        self.user = _intern(user)
+        self.mode = sys.intern(mode if isinstance(mode, str) else str(mode))
         self.content = content
         self.restarts = restarts
-        self.hash = (
-            hashlib.blake2b(self.content.encode()).hexdigest() if self.content else None
-        )
+        self.template = bool(template)
+        # names of the variables a template uses, its render depends on
+        # nothing else
+        self.variables = ()
+        if self.template:
+            if self.content is None:
+                raise ValueError(f"file '{path}' is a template without content")
+            self.variables = _template_variables(path, self.content)
+            # hashed per location, once rendered
+            self.hash = None
+        else:
+            self.hash = (
+                hashlib.blake2b(self.content.encode()).hexdigest()
+                if self.content
+                else None
+            )
+
+    def render(self, variables):
+        """Return a copy of the file with its template rendered."""
+        missing = [name for name in self.variables if name not in variables]
+        if missing:
+            raise ValueError(
+                f"no value for variable '{missing[0]}' in template of file '{self.path}'"
+            )
+        values = tuple((name, variables[name]) for name in self.variables)
+        f = copy.copy(self)
+        f.content, f.hash = _render(self.content, values)
+        f.template = False
+        return f
+
+    def todict(self):
+        return {
+            "path": self.path,
+            "action": self.action,
+            "group": self.group,
+            "user": self.user,
+            "mode": self.mode,
+            "content": self.content.encode() if self.content is not None else None,
+            "hash": self.hash,
+            "restarts": self.restarts,
+        }
+
+    def resource(self):
+        return f"file:{self.path}"
+
+    def fingerprint(self):
+        return f"{self.action}:{self.hash}:{self.user}:{self.group}:{self.mode}"
+
+
+class Directory:
+    """A tree of files kept in sync with a local source directory.
+
+    The source is walked and hashed on first use rather than when the
+    scenario is loaded: it can change without the scenario file changing,
+    and compiled scenarios are cached by the scenario file alone.
+    """
+
+    __slots__ = (
+        "path",
+        "source",
+        "group",
+        "user",
+        "mode",
+        "purge",
+        "restarts",
+        "base_dir",
+        "_entries",
+    )
+
+    # one walk of each source, however many locations want it at once
+    _lock = threading.Lock()
+
+    def __init__(
+        self,
+        *,
+        path,
+        source,
+        group,
+        user,
+        mode,
+        purge=False,
+        restarts=[],
+    ):
+        self.path = path
+        self.source = source
+        self.group = _intern(group)
+        self.user = _intern(user)
+        self.mode = sys.intern(mode if isinstance(mode, str) else str(mode))
+        self.purge = purge
+        self.restarts = restarts
+        # directory relative sources are relative to, set by load()
+        self.base_dir = None
+        self._entries = None
+
+    def source_dir(self):
+        if self.base_dir is None:
+            return self.source
+        return os.path.join(self.base_dir, self.source)
+
+    def entries(self):
+        """Return [relative path, size, hash] of every file in the source."""
+        with self._lock:
+            if self._entries is None:
+                self._entries = _walk(self.source_dir())
+            return self._entries
+
+    def archive(self, paths):
+        """Return an uncompressed tar archive of the given relative paths."""
+        buf = io.BytesIO()
+        # symlinks are followed, as they are by entries(). GNU format, as
+        # PAX adds a header to every file for its sub-second mtime
+        with tarfile.open(
+            fileobj=buf, mode="w", dereference=True, format=tarfile.GNU_FORMAT
+        ) as tar:
+            for path in paths:
+                tar.add(
+                    os.path.join(self.source_dir(), path),
+                    arcname=path,
+                    recursive=False,
+                )
+        return buf.getvalue()
+
+    def todict(self):
+        return {
+            "path": self.path,
+            "source": self.source_dir(),
+            "group": self.group,
+            "user": self.user,
+            "mode": self.mode,
+            "purge": self.purge,
+            "restarts": self.restarts,
+        }
+
+    def resource(self):
+        return f"directory:{self.path}"
 
 
 class Package:
+    __slots__ = ("name", "action", "restarts")
+
     def __init__(
         self,
         *,
@@ -40,19 +214,55 @@ class Package:
         self.name = name
         if action not in ["install", "remove"]:
             raise ValueError("package.action must be either 'add' or 'remove'")
-        self.action = action
+        self.action = sys.intern(action)
         self.restarts = restarts
 
+    def todict(self):
+        return {
+            "name": self.name,
+            "action": self.action,
+            "restarts": self.restarts,
+        }
+
+    def resource(self):
+        return f"package:{self.name}"
+
+    def fingerprint(self):
+        return self.action
+
 
 class Scenario:
     def __init__(
         self,
         *,
         files=[],
+        directories=[],
         packages=[],
     ):
         self.files = _cls_list(files, File)
+        self.directories = _cls_list(directories, Directory)
         self.packages = _cls_list(packages, Package)
+        # hash of the scenario file, set by load()
+        self.hash = None
+
+    def todict(self):
+        return {
+            "files": [f.todict() for f in self.files],
+            "directories": [d.todict() for d in self.directories],
+            "packages": [p.todict() for p in self.packages],
+        }
+
+    def fingerprints(self):
+        """Return {resource: fingerprint} of the desired state of each resource."""
+        return {r.resource(): r.fingerprint() for r in self.files + self.packages}
+
+    def render(self, variables):
+        """Return the scenario for a location, its templates rendered."""
+        if not any(f.template for f in self.files):
+            return self
+        s = copy.copy(self)
+        s.files = [f.render(variables) if f.template else f for f in self.files]
+        return s
 
 
 def _cls_list(items, cls):
@@ -62,8 +272,112 @@ def _cls_list(items, cls):
     return l
 
 
-def load(filename):
-    with open(filename, "r") as f:
-        d = yaml.safe_load(f)
+def _template_variables(path, content):
+    names = set()
+    for m in string.Template.pattern.finditer(content):
+        if m.group("invalid") is not None:
+            line = content.count("\n", 0, m.start()) + 1
+            raise ValueError(
+                f"invalid placeholder on line {line} of template of file '{path}'; use '$$' for a literal '$'"
+            )
+        name = m.group("named") or m.group("braced")
+        if name is not None:
+            names.add(name)
+    return tuple(sorted(names))
+
+
+@functools.lru_cache(maxsize=_RENDER_CACHE_SIZE)
+def _render(template, values):
+    # keyed by the template and the values of just the variables it uses,
+    # so locations that agree on them share one render and one hash; the
+    # cache is bounded, so memory stays flat however many locations there
+    # are
+    content = string.Template(template).substitute(dict(values))
+    return content, hashlib.blake2b(content.encode()).hexdigest()
+
+
+def _walk(source):
+    if not os.path.isdir(source):
+        raise ValueError(f"directory source '{source}' doesn't exist")
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not os.path.isfile(path):
+                continue
+            hasher = hashlib.blake2b()
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            rel = os.path.relpath(path, source).replace(os.sep, "/")
+            entries.append([rel, size, hasher.hexdigest()])
+    return entries
+
+
+def _intern(s):
+    return sys.intern(s) if isinstance(s, str) else s
+
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "stagehand", "scenarios")
+
+
+def load(filename, cache_dir=None):
+    """Load a scenario file.
+
+    If cache_dir is given the compiled scenario is kept there, keyed by the
+    hash of the file, so loading the same scenario again skips parsing the
+    YAML and hashing the file content.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    scenario_hash = hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.blake2b(data, digest_size=20)
+        key.update(str(_CACHE_VERSION).encode())
+        cache_path = os.path.join(cache_dir, f"{key.hexdigest()}.pickle")
+        try:
+            with open(cache_path, "rb") as f:
+                s = pickle.load(f)
+            s.hash = scenario_hash
+            _set_base_dir(s, filename)
+            return s
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+    d = yaml.load(data, Loader=_SafeLoader)
     s = Scenario(**d)
+    s.hash = scenario_hash
+    _set_base_dir(s, filename)
+
+    if cache_path is not None:
+        _save_compiled(s, cache_path)
     return s
+
+
+def _set_base_dir(s, filename):
+    # directory sources are relative to the scenario file; set after loading
+    # as the same scenario file could be anywhere
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    for d in s.directories:
+        d.base_dir = base_dir
+
+
+def _save_compiled(s, cache_path):
+    # a missing or unwritable cache only costs a re-parse next time
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(s, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except (OSError, pickle.PicklingError):
+        os.remove(tmp_path)
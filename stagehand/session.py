@@ -1,123 +1,451 @@
+import collections
+import functools
 import inspect
-import io
+import itertools
 import json
+import lzma
+import queue
 import random
 import string
-
-import paramiko
+import threading
+import time
+import zlib
 
 from . import agent
 from . import commands
 from . import debug
+from . import tracing
+from . import transport
+
+
+# the agent bundle is read from stdin by this one-liner, the rest of stdin
+# is then used for the client-server protocol
+_BOOTSTRAP = "import sys,zlib;exec(zlib.decompress(sys.stdin.buffer.read({})))"
+
+_BUNDLE = """\
+import sys
+import types
+
+commands = types.ModuleType("commands")
+exec(compile({commands!r}, "commands.py", "exec"), commands.__dict__)
+sys.modules["commands"] = commands
+exec(compile({agent!r}, "agent.py", "exec"), {{"__name__": "__main__"}})
+"""
 
 
 class Session:
     def __init__(
         self,
         *,
-        hostname,
-        username,
-        password,
-        port=22,
+        transport,
+        bootstrap="sftp",
+        agent_options=None,
+        compression="auto",
+        max_in_flight=64,
+        tracer=None,
     ):
-        self.hostname = hostname
-        self.username = username
-        self.password = password
-        self.port = port
+        self.transport = transport
+        if bootstrap not in ["sftp", "exec"]:
+            raise ValueError("bootstrap must be either 'sftp' or 'exec'")
+        if not transport.sftp:
+            # nowhere to copy the agent to
+            bootstrap = "exec"
+        self.bootstrap = bootstrap
+        # keyword arguments for the commands.Configure sent at startup
+        self.agent_options = agent_options if agent_options is not None else {}
+        if compression not in ["none", "zlib", "lzma", "auto"]:
+            raise ValueError(
+                "compression must be one of 'none', 'zlib', 'lzma' or 'auto'"
+            )
+        self.compression = compression
+        # cap on unanswered commands, so there's only so much queued up for
+        # the agent at once
+        self.max_in_flight = max_in_flight
 
         self.session_id = "".join(
             random.choices(string.digits + string.ascii_lowercase, k=10)
         )
         self.remote_dir = f"/tmp/stagehand_{self.session_id}/"
 
+        self._request_ids = itertools.count(1)
+        self._pending = {}
+        # frames are written to the agent by _writer, so sending never
+        # blocks: otherwise a large command could block on the agent, while
+        # it's blocked writing a large response that would only be read
+        # once sending completes
+        self._send_queue = queue.Queue()
+        self._writer = None
+
+        self.tracer = tracer if tracer is not None else tracing.Tracer(enabled=False)
+        # request id -> [command name, send start, send end], for tracing;
+        # send end is set by _writer once the frame's written
+        self._sent = {}
+
     def start(self):
         try:
-            self._connect_ssh()
-        except paramiko.ssh_exception.AuthenticationException:
+            self.transport.connect()
+        except transport.TransportAuthError:
             raise SessionAuthError()
-        self._start_agent()
+        start = time.perf_counter()
+        with self.tracer.span("bootstrap", "agent", bootstrap=self.bootstrap):
+            self._start_agent()
+        self._writer = threading.Thread(target=self._write_frames, daemon=True)
+        self._writer.start()
+        debug.print(
+            f"agent bootstrap ({self.bootstrap}) took {time.perf_counter() - start:.3f} seconds"
+        )
+        # pipelined, the response is only waited for by configuration()
+        cmd = commands.Configure(
+            report_timings=self.tracer.enabled, **self.agent_options
+        )
+        self._configure = self.submit(cmd)
 
     def stop(self):
         self._stop_agent()
-        self._close_ssh()
+        self.transport.close()
+
+    def close(self):
+        """Close the connection without waiting on the agent.
+
+        For when the session failed, and the agent may have gone or have
+        responses that won't be read; safe to call after stop().
+        """
+        if self._writer is not None:
+            self._send_queue.put(None)
+        self._agent = None
+        self.transport.close()
 
     def execute_command(self, cmd):
+        return self.submit(cmd).result()
+
+    def submit(self, cmd):
+        """Send a command without waiting for its response.
+
+        Returns a CommandFuture; responses are matched to commands by
+        request id, so any number of commands can be in flight at once.
+        """
+        return self._submit(cmd, CommandFuture)
+
+    def submit_stream(self, cmd):
+        """Send a command that's answered with a stream of responses.
+
+        Returns a CommandStream which yields every response sharing the
+        command's request id, ending with the "<name>-response" frame.
+        """
+        return self._submit(cmd, CommandStream)
+
+    def _submit(self, cmd, handler_cls):
+        while len(self._pending) >= self.max_in_flight:
+            self._recv_response()
+
+        cmd.id = next(self._request_ids)
+        handler = handler_cls(self, cmd)
+        self._pending[cmd.id] = handler
+
         d = cmd.__dict__
-        j = json.dumps(d)
-        debug.print(f"==>> {type(cmd).__name__}: {j}")
-        self._agent_send(j)
+        if debug.enabled():
+            debug.print(f"==>> {type(cmd).__name__}: {_debug_json(d)}")
+        sent = None
+        if self.tracer.enabled:
+            sent = [cmd.name, time.perf_counter(), None]
+            self._sent[cmd.id] = sent
+        self._agent_send(d, sent)
+        return handler
 
-        j = self._agent_recv()
-        d = json.loads(j)
+    def configuration(self):
+        cmd_resp = self._configure.result()
+        if cmd_resp.result == "error":
+            raise SessionError(f"couldn't configure agent: {cmd_resp.error}")
+        return cmd_resp
+
+    def _recv_response(self):
+        d = self._agent_recv()
+        received = time.perf_counter()
+        if d is None:
+            raise SessionError("agent closed the connection")
         resp_cmd = commands.fromdict(d)
-        debug.print(f"<<== {type(resp_cmd).__name__}: {j}")
-        return resp_cmd
-
-    def _connect_ssh(self):
-        self.ssh = paramiko.client.SSHClient()
-        self.ssh.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
-        self.ssh.connect(
-            self.hostname,
-            port=self.port,
-            username=self.username,
-            password=self.password,
-        )
+        if debug.enabled():
+            debug.print(f"<<== {type(resp_cmd).__name__}: {_debug_json(d)}")
+        handler = self._pending.get(resp_cmd.id)
+        if handler is None:
+            raise SessionError(f"unexpected response for request id {resp_cmd.id}")
+        if handler._put(resp_cmd):
+            del self._pending[resp_cmd.id]
+            if self.tracer.enabled:
+                self._trace_round_trip(resp_cmd, received)
 
-    def _close_ssh(self):
-        self.ssh.close()
-        self.ssh = None
+    def _trace_round_trip(self, resp_cmd, received):
+        # a round trip is split into sending the command, the agent
+        # processing it (as reported by the agent), and receiving the
+        # response: network latency both ways, plus any time the response
+        # waited to be read
+        name, start, sent = self._sent.pop(resp_cmd.id)
+        if sent is None:
+            # the response beat the writer to recording the send
+            sent = received
+        timings = resp_cmd.timings or {"agent": 0.0, "spans": []}
+        agent = min(timings["agent"], received - sent)
+        receive = received - sent - agent
+        rid = resp_cmd.id
+        self.tracer.add(
+            name,
+            start,
+            received - start,
+            "rpc",
+            request_id=rid,
+            send=round(sent - start, 6),
+            agent=round(agent, 6),
+            receive=round(receive, 6),
+        )
+        self.tracer.add("send", start, sent - start, "rpc", request_id=rid)
+        # the agent's clock isn't ours, its time is assumed to sit in the
+        # middle of the rest
+        agent_start = sent + receive / 2
+        self.tracer.add("agent", agent_start, agent, "agent", request_id=rid)
+        for span_name, offset, duration in timings["spans"]:
+            self.tracer.add(
+                span_name, agent_start + offset, duration, "agent", request_id=rid
+            )
+        self.tracer.add(
+            "receive", agent_start + agent, receive / 2, "rpc", request_id=rid
+        )
 
     def _start_agent(self):
+        if self.bootstrap == "exec":
+            self._start_agent_exec()
+            return
         self._exec_simple_command(f"mkdir -p {self.remote_dir}")
-        self._put_file(inspect.getfile(agent), f"{self.remote_dir}agent.py")
-        self._put_file(inspect.getfile(commands), f"{self.remote_dir}commands.py")
-        stdin, stdout, stderr = self.ssh.exec_command(
+        self.transport.put_file(inspect.getfile(agent), f"{self.remote_dir}agent.py")
+        self.transport.put_file(
+            inspect.getfile(commands), f"{self.remote_dir}commands.py"
+        )
+        stdin, stdout, stderr = self.transport.exec_command(
             f"cd {self.remote_dir}; python3 agent.py"
         )
         msg = stdout.read(2)
         assert msg == b"OK"
         self._agent = {"stdin": stdin, "stdout": stdout, "stderr": stderr}
 
+    def _start_agent_exec(self):
+        # one exec: the compressed agent bundle goes over stdin, nothing is
+        # written to the target so there's nothing to clean up either
+        bundle = _agent_bundle()
+        cmd = f"python3 -c '{_BOOTSTRAP.format(len(bundle))}' --no-logs"
+        debug.print(f"agent cmd '{cmd}' ({len(bundle)} byte bundle)")
+        stdin, stdout, stderr = self.transport.exec_command(cmd)
+        stdin.write(bundle)
+        stdin.flush()
+        msg = stdout.read(2)
+        if msg != b"OK":
+            err = stderr.read().decode().strip()
+            raise SessionError(f"agent failed to start: {err}")
+        self._agent = {"stdin": stdin, "stdout": stdout, "stderr": stderr}
+
     def _stop_agent(self):
         self._agent_send("BYE")
+        self._send_queue.put(None)
+        self._writer.join()
         msg = self._agent["stdout"].read(2)
         assert msg == b"OK"
         self._agent = None
-        self._exec_simple_command(f"rm -rf {self.remote_dir}")
+        if self.bootstrap == "sftp":
+            self._exec_simple_command(f"rm -rf {self.remote_dir}")
+
+    def _agent_send(self, msg, sent=None):
+        # queued for _writer; sent is the command's tracing entry, if any
+        self._send_queue.put((commands.pack_frame(msg), sent))
 
-    def _agent_send(self, msg):
-        msg_len = f"{len(msg):10}"
-        msg_bytes = (msg_len + msg).encode("utf-8")
-        self._agent["stdin"].write(msg_bytes)
-        self._agent["stdin"].flush()
+    def _write_frames(self):
+        stdin = self._agent["stdin"]
+        while True:
+            item = self._send_queue.get()
+            if item is None:
+                return
+            frame, sent = item
+            try:
+                stdin.write(frame)
+                stdin.flush()
+            except OSError as e:
+                # the agent's gone, which reading its responses reports
+                debug.print(f"couldn't send to agent: {e}")
+                return
+            if sent is not None:
+                sent[2] = time.perf_counter()
 
     def _agent_recv(self):
-        msg_len = self._agent["stdout"].read(10)
-        if msg_len == b"":
-            return None
-        msg_len = int(msg_len)
-        msg_bytes = self._agent["stdout"].read(msg_len)
-        msg = msg_bytes.decode("utf-8")
-        return msg
+        return commands.read_frame(self._agent["stdout"])
 
     def _exec_simple_command(self, cmd):
-        debug.print(f"SSH cmd '{cmd}'")
-        stdin, stdout, stderr = self.ssh.exec_command(cmd)
+        debug.print(f"cmd '{cmd}'")
+        stdin, stdout, stderr = self.transport.exec_command(cmd)
         out = stdout.read().decode().strip()
         err = stderr.read().decode().strip()
         return out, err
 
-    def _put_file(self, local, remote):
-        debug.print(f"SFTP putting file '{local}' to '{remote}'")
-        sftp = self.ssh.open_sftp()
-        sftp.put(local, remote, confirm=True)
-        sftp.close()
+    def submit_write_data(self, data, remote, *, user, group, mode):
+        """Write data to remote through the agent channel, compressed.
+
+        Doesn't wait for it to be written: returns (CommandFuture, number of
+        bytes sent). The future's FileWriteResponse holds the props of the
+        file once written.
+        """
+        compression, payload = self.encode(data)
+        debug.print(
+            f"agent writing {len(data)} bytes ({len(payload)} {compression}) to '{remote}'"
+        )
+        cmd = commands.FileWrite(
+            path=remote,
+            content=payload,
+            compression=compression,
+            user=user,
+            group=group,
+            mode=mode,
+        )
+        return self.submit(cmd), len(payload)
+
+    def sync_directory(self, archive, remote, *, user, group, mode, props, delete):
+        """Sync remote with a tar archive of changed files, through the agent.
+
+        Returns (DirectorySyncResponse, number of bytes sent).
+        """
+        compression, payload = self.encode(archive)
+        debug.print(
+            f"agent syncing {len(archive)} bytes ({len(payload)} {compression}) to '{remote}'"
+        )
+        cmd = commands.DirectorySync(
+            path=remote,
+            archive=payload,
+            compression=compression,
+            user=user,
+            group=group,
+            mode=mode,
+            props=props,
+            delete=delete,
+        )
+        return self.execute_command(cmd), len(payload)
+
+    def encode(self, data):
+        """Return (compression, payload) of data, to send through the agent.
+
+        Compressed as configured, and as the agent supports; payload is
+        data itself if it doesn't compress.
+        """
+        compression = self._negotiate_compression()
+        payload = _compress(data, compression)
+        if len(payload) >= len(data):
+            # tiny or incompressible
+            return "none", data
+        return compression, payload
+
+    def _negotiate_compression(self):
+        supported = self.configuration().compression
+        if self.compression == "auto":
+            preferred = ["lzma", "zlib"]
+        else:
+            preferred = [self.compression, "zlib"]
+        for compression in preferred:
+            if compression == "none" or compression in supported:
+                return compression
+        return "none"
 
     def put_data(self, data, remote):
-        debug.print(f"SFTP putting data to '{remote}'")
-        sftp = self.ssh.open_sftp()
-        sftp.putfo(io.BytesIO(data), remote, confirm=True)
-        sftp.close()
+        self.transport.put_data(data, remote)
+
+
+@functools.lru_cache(maxsize=None)
+def _agent_bundle():
+    src = _BUNDLE.format(
+        commands=inspect.getsource(commands),
+        agent=inspect.getsource(agent),
+    )
+    return zlib.compress(src.encode(), 9)
+
+
+def _compress(data, compression):
+    # the same content usually goes to many locations, so compressed
+    # payloads are kept, least recently used first out once the content
+    # and payloads kept add up to _COMPRESS_CACHE_BYTES
+    global _compress_cache_bytes
+
+    if compression == "none":
+        return data
+    key = (compression, data)
+    with _compress_lock:
+        payload = _compress_cache.get(key)
+        if payload is not None:
+            _compress_cache.move_to_end(key)
+            return payload
+    if compression == "zlib":
+        payload = zlib.compress(data)
+    else:
+        payload = lzma.compress(data)
+    size = len(data) + len(payload)
+    if size > _COMPRESS_CACHE_BYTES // 8:
+        # would push out too much else
+        return payload
+    with _compress_lock:
+        if key not in _compress_cache:
+            _compress_cache[key] = payload
+            _compress_cache_bytes += size
+        while _compress_cache_bytes > _COMPRESS_CACHE_BYTES:
+            (_, old_data), old_payload = _compress_cache.popitem(last=False)
+            _compress_cache_bytes -= len(old_data) + len(old_payload)
+    return payload
+
+
+_COMPRESS_CACHE_BYTES = 64 * 1024 * 1024
+_compress_cache = collections.OrderedDict()
+_compress_cache_bytes = 0
+_compress_lock = threading.Lock()
+
+
+def _debug_json(d):
+    return json.dumps(d, default=lambda o: f"<{len(o)} bytes>")
+
+
+class CommandFuture:
+    def __init__(self, session, cmd):
+        self.session = session
+        self.request_id = cmd.id
+        self._done = False
+        self._result = None
+
+    def result(self):
+        # responses are read on demand; reading may resolve other futures
+        # before this one
+        while not self._done:
+            self.session._recv_response()
+        return self._result
+
+    def _put(self, resp_cmd):
+        self._result = resp_cmd
+        self._done = True
+        return True
+
+
+class CommandStream:
+    def __init__(self, session, cmd):
+        self.session = session
+        self.request_id = cmd.id
+        self._final_name = f"{cmd.name}-response"
+        self._responses = collections.deque()
+
+    def __iter__(self):
+        while True:
+            while not self._responses:
+                self.session._recv_response()
+            resp_cmd = self._responses.popleft()
+            yield resp_cmd
+            if resp_cmd.name == self._final_name:
+                return
+
+    def _put(self, resp_cmd):
+        self._responses.append(resp_cmd)
+        return resp_cmd.name == self._final_name
+
+
+class SessionError(Exception):
+    pass
 
 
 class SessionAuthError(Exception):
@@ -0,0 +1,123 @@
+import contextlib
+import json
+import threading
+import time
+
+FORMATS = ["jsonl", "chrome"]
+
+
+class Span:
+    __slots__ = ("name", "category", "location", "start", "duration", "args")
+
+    def __init__(self, *, name, category, location, start, duration, args):
+        self.name = name
+        self.category = category
+        self.location = location
+        # seconds since the epoch
+        self.start = start
+        self.duration = duration
+        self.args = args
+
+    def todict(self):
+        d = {
+            "name": self.name,
+            "category": self.category,
+            "location": self.location,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6),
+        }
+        d.update(self.args)
+        return d
+
+
+class Tracer:
+    """Collects spans of time, e.g. connecting or a command's round trip.
+
+    Times are given as time.perf_counter() values and kept as wall clock
+    times, so spans from several tracers line up. A disabled tracer records
+    nothing. Tracers made by child() share their parent's spans.
+    """
+
+    def __init__(self, *, enabled=True, location=""):
+        self.enabled = enabled
+        self.location = location
+        self.spans = []
+        self._lock = threading.Lock()
+        self._offset = time.time() - time.perf_counter()
+
+    def child(self, location):
+        t = Tracer(enabled=self.enabled, location=location)
+        t.spans = self.spans
+        t._lock = self._lock
+        t._offset = self._offset
+        return t
+
+    @contextlib.contextmanager
+    def span(self, name, category="stagehand", **args):
+        # args can be added to from within the block
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, start, time.perf_counter() - start, category, **args)
+
+    def add(self, name, start, duration, category="stagehand", **args):
+        if not self.enabled:
+            return
+        span = Span(
+            name=name,
+            category=category,
+            location=self.location,
+            start=start + self._offset,
+            duration=duration,
+            args=args,
+        )
+        with self._lock:
+            self.spans.append(span)
+
+    def write(self, path, format="jsonl"):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        with open(path, "w") as f:
+            if format == "chrome":
+                json.dump(_chrome_trace(spans), f)
+            else:
+                for span in spans:
+                    f.write(json.dumps(span.todict()))
+                    f.write("\n")
+
+
+def _chrome_trace(spans):
+    # Chrome's trace event format, in microseconds, with a thread per
+    # location. Pipelined commands overlap, so the spans of each request are
+    # async events grouped by request id rather than complete ("X") events
+    tids = {}
+    events = []
+    for span in spans:
+        if span.location not in tids:
+            tids[span.location] = len(tids) + 1
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tids[span.location],
+                    "args": {"name": span.location or "stagehand"},
+                }
+            )
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ts": round(span.start * 10**6),
+            "pid": 1,
+            "tid": tids[span.location],
+            "args": span.args,
+        }
+        if "request_id" in span.args:
+            event.update(ph="b", id=f"{span.location}/{span.args['request_id']}")
+            end = dict(event, ph="e", ts=round((span.start + span.duration) * 10**6))
+            events.extend([event, end])
+        else:
+            event.update(ph="X", dur=round(span.duration * 10**6))
+            events.append(event)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
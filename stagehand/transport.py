@@ -0,0 +1,203 @@
+import io
+import subprocess
+import urllib.parse
+
+import paramiko
+
+from . import debug
+from . import tracing
+
+
+def from_location(location, *, password=None, key_filename=None, tracer=None):
+    """Return the transport for a location.
+
+    'local://' runs the agent on this machine, and 'exec://<command>' runs
+    it under a local command, e.g. 'exec://chroot /srv/image' or
+    'exec://docker exec -i web1'. Anything else is an SSH location,
+    '[ssh://]username@hostname[:port]'.
+    """
+    if location.startswith("local://"):
+        if location != "local://":
+            raise ValueError(
+                f"can't parse location '{location}'; 'local://' takes nothing after it"
+            )
+        return LocalTransport(tracer=tracer)
+    if location.startswith("exec://"):
+        command = location[len("exec://") :].strip()
+        if command == "":
+            raise ValueError(
+                f"can't parse location '{location}'; make sure it's in the format 'exec://<command>', e.g. 'exec://chroot /srv/image'"
+            )
+        return LocalTransport(command=command, tracer=tracer)
+
+    if location.startswith("ssh://"):
+        url = urllib.parse.urlparse(location)
+    else:
+        url = urllib.parse.urlparse(f"ssh://{location}")
+    hostname = url.hostname
+    port = url.port
+    if port is None:
+        port = 22
+    username = url.username
+    if hostname is None or username is None:
+        raise ValueError(
+            f"can't parse location '{location}'; make sure it's in the format 'username@hostname[:port]', e.g. 'root@10.20.30.40'"
+        )
+    return SSHTransport(
+        hostname=hostname,
+        port=port,
+        username=username,
+        password=password,
+        key_filename=key_filename,
+        tracer=tracer,
+    )
+
+
+def uses_ssh(location):
+    return not location.startswith(("local://", "exec://"))
+
+
+class SSHTransport:
+    """Runs commands on, and puts files to, a location over SSH."""
+
+    # files can be put without going through the agent
+    sftp = True
+
+    def __init__(
+        self,
+        *,
+        hostname,
+        username,
+        password=None,
+        key_filename=None,
+        port=22,
+        tracer=None,
+    ):
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.port = port
+        self.tracer = tracer if tracer is not None else tracing.Tracer(enabled=False)
+        self.ssh = None
+        self._sftp = None
+        self.sftp_opens = 0
+        self.sftp_bytes = 0
+
+    def connect(self):
+        self.ssh = _SSHClient(self.tracer)
+        self.ssh.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+        try:
+            with self.tracer.span("ssh-connect", "ssh"):
+                self.ssh.connect(
+                    self.hostname,
+                    port=self.port,
+                    username=self.username,
+                    password=self.password,
+                    key_filename=self.key_filename,
+                    allow_agent=True,
+                    look_for_keys=True,
+                )
+        except paramiko.ssh_exception.AuthenticationException:
+            raise TransportAuthError()
+
+    def close(self):
+        if self.ssh is None:
+            return
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        self.ssh.close()
+        self.ssh = None
+        debug.print(
+            f"SFTP channels opened: {self.sftp_opens}, bytes transferred: {self.sftp_bytes}"
+        )
+
+    def exec_command(self, cmd):
+        # returns (stdin, stdout, stderr) as binary files
+        return self.ssh.exec_command(cmd)
+
+    def put_file(self, local, remote):
+        debug.print(f"SFTP putting file '{local}' to '{remote}'")
+        with self.tracer.span("sftp-put", "sftp", path=remote) as args:
+            attrs = self._get_sftp().put(local, remote, confirm=True)
+            args["bytes"] = attrs.st_size
+        self.sftp_bytes += attrs.st_size
+
+    def put_data(self, data, remote):
+        debug.print(f"SFTP putting data to '{remote}'")
+        with self.tracer.span("sftp-put", "sftp", path=remote, bytes=len(data)):
+            self._get_sftp().putfo(io.BytesIO(data), remote, confirm=True)
+        self.sftp_bytes += len(data)
+
+    def _get_sftp(self):
+        # one SFTP channel per session, opened on first use
+        if self._sftp is None:
+            debug.print("SFTP opening channel")
+            self._sftp = self.ssh.open_sftp()
+            self.sftp_opens += 1
+        return self._sftp
+
+
+class LocalTransport:
+    """Runs commands as local subprocesses, talking to them over pipes.
+
+    With a command, e.g. 'chroot /srv/image', commands are run under it
+    instead: it's given the command's arguments. There's no SFTP, so no
+    put_file or put_data: files go through the agent.
+    """
+
+    sftp = False
+
+    def __init__(self, *, command=None, tracer=None):
+        self.command = command
+        self.tracer = tracer if tracer is not None else tracing.Tracer(enabled=False)
+        self._procs = []
+
+    def connect(self):
+        pass
+
+    def close(self):
+        for proc in self._procs:
+            # output first: a process blocked writing it, e.g. one whose
+            # responses weren't read after a failure, then fails rather than
+            # blocking its input being closed and waiting on it
+            proc.stdout.close()
+            proc.stderr.close()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+        self._procs = []
+
+    def exec_command(self, cmd):
+        # returns (stdin, stdout, stderr) as binary files
+        if self.command is not None:
+            cmd = f"{self.command} {cmd}"
+        debug.print(f"local cmd '{cmd}'")
+        proc = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._procs.append(proc)
+        return proc.stdin, proc.stdout, proc.stderr
+
+
+class _SSHClient(paramiko.client.SSHClient):
+    # times authentication on its own, separately from the connection and
+    # key exchange around it
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+
+    def _auth(self, *args, **kwargs):
+        with self.tracer.span("ssh-auth", "ssh"):
+            return super()._auth(*args, **kwargs)
+
+
+class TransportAuthError(Exception):
+    pass